@@ -1,31 +1,159 @@
-import os
-
 # webgen adds the following fields:
 #   page_path
 #   page_path
 #   file_name
 #   build_phase
 #   build_dirpath
+#   read_build_file(path)
+#   build_file_info(path)
+#   asset_url(path)
+#   inline_css(path)
+#   picture(path, alt, sizes, attrs)
+#   bundle(name, inline)
+#   preload(path, sizes)
+#   load_manifest(dirpath)
+#   load_preloads(dirpath)
+
+
+# webgen --purge-css removes the rules of these stylesheets that no content file mentions.
+# the rest of res/, e.g. res/css-ur, is served as is to other consumers
+purge_css = {
+    'stylesheets': [
+        'res/css/bootstrap.min.css',
+        'res/css/main.css',
+        'res/css/stats.css',
+        'res/css/connect.css',
+    ],
+    # source globs, relative to this dir
+    'content': [
+        'gen.py',
+        '**/*.j2',
+        '**/*.html',
+        '**/*.js',
+    ],
+    # selectors for classes that scripts build at runtime
+    'allowlist': [
+        # bootstrap popper placement, `bs-popover-${placement}`
+        r'\.bs-(popover|tooltip)-',
+    ],
+}
+
+# webgen --subset-fonts adds subsets of the fonts in these stylesheets with just the text
+# the content files use. the full fonts stay as the fallback for any other text
+subset_fonts = {
+    'stylesheets': [
+        'res/fonts/barlow.css',
+        'res/fonts/material-symbols-outlined.css',
+        'res/fonts/noto-sans.css',
+        'res/fonts/pacifico.css',
+    ],
+    # source globs, relative to this dir
+    'content': [
+        'gen.py',
+        '**/*.j2',
+        '**/*.md',
+        # the site's own scripts, lib/ is third party code that renders no text
+        '*.js',
+        'lib-ur/*.js',
+    ],
+    # icon fonts drawn by ligature, the class of the icon elements -> font family.
+    # these are replaced by their subset, so every icon must appear literally as `<... class="...">name<`
+    # in the content, not e.g. set through `textContent`
+    'ligatures': {
+        'material-symbols-outlined': 'Material Symbols Outlined',
+    },
+}
+
+# webgen --images writes avif/webp variants of these images for `picture()`
+images = {
+    'variants': [
+        'res/images/logo-placeholder.png',
+    ],
+    'widths': [200, 400],
+}
+
+
+# webgen --bundle concatenates the files of each bundle into its path, `bundle()` writes the elements that load it.
+# `eager` blocks rendering, `defer` runs after parsing and `idle` loads after the page has loaded, `delay` ms later.
+# without --bundle, e.g. in `serve`, the files load one by one in the same way
+bundles = {
+    'bundles/app.css': {
+        'files': [
+            'res/css/bootstrap.min.css',
+            'res/css/main.css',
+            'res/css/stats.css',
+            'res/css/connect.css',
+        ],
+        'load': 'eager',
+    },
+    'bundles/app.js': {
+        'files': [
+            'client.js',
+            'window.js',
+            'flag.js',
+        ],
+        'load': 'eager',
+    },
+    'bundles/lib.js': {
+        'files': [
+            'lib/jquery.min.js',
+            'lib/bootstrap.bundle.min.js',
+        ],
+        'load': 'defer',
+    },
+    'bundles/stats.js': {
+        'files': [
+            'lib/d3.min.js',
+            'stats.js',
+        ],
+        'load': 'defer',
+    },
+    # the animated logo replaces a placeholder image, so it can wait until the page is idle
+    'bundles/logo.js': {
+        'files': [
+            'lib/p5.min.js',
+            'logo.js',
+            'sketch_220824a.js',
+        ],
+        'load': 'idle',
+        # slow phones wait a while more, `isSlowMobile` is from client.js
+        'delay': 4000,
+        'delay_if': 'isSlowMobile',
+    },
+}
+
+
+# webgen --budgets fails the build when a page goes over its budget, see webgen-budget.json in each build.
+# page globs -> max bytes loaded (`raw`, `gzip`, `br`), `inlined` bytes, `requests`, and bytes of the largest `asset`
+budgets = {
+    '*': {
+        'br': 400000,
+        'requests': 24,
+        # the logo bundle, mostly p5
+        'asset': 1000000,
+    },
+    # the index inlines its stylesheets and scripts
+    'index.html': {
+        'inlined': 24000,
+    },
+}
 
 
 def css(path, inline):
     if inline:
-        with open(os.path.join(build_dirpath, path), 'r') as f:
-            content = f.read()
-        return f"""<style>{content}</style>"""
+        return inline_css(path)
     else:
-        return f"""<link rel="stylesheet" href="/{path}">"""
+        return f"""<link rel="stylesheet" href="{asset_url(path)}">"""
 
 
 def js(path, inline, defer=False):
     if inline:
-        with open(os.path.join(build_dirpath, path), 'r') as f:
-            content = f.read()
+        content = read_build_file(path)
         return f"""<script>{content}</script>"""
     elif defer:
-        return f"""<script src="/{path}" defer></script>"""
+        return f"""<script src="{asset_url(path)}" defer></script>"""
     else:
-        return f"""<script src="/{path}"></script>"""
+        return f"""<script src="{asset_url(path)}"></script>"""
 
 
 def html_header():
@@ -58,6 +186,19 @@ def title_icons_meta():
     """
 
 
+def preloads():
+    # webgen also sends these, and the page's stylesheets and scripts, as `Link` headers, see nginx/gen.py
+    return """
+    {font_noto_sans}
+    {image_logo_placeholder}
+    """.format(
+        # the body text
+        font_noto_sans=preload('res/fonts/Noto-Sans-Latin-400.woff2'),
+        # the first image, see `tab_header`
+        image_logo_placeholder=preload('res/images/logo-placeholder.png', sizes='200px'),
+    )
+
+
 def fonts():
     if build_phase == 'final':
         # inline resources for the index
@@ -85,48 +226,24 @@ def app_js_css():
     else:
         inline = False
 
-    if build_phase == 'final' and page_path == 'index':
-        # to improve page load time,
-        # the script elements are manually inserted after a delay
+    if page_path == 'index':
+        # the index has no stats
         stats_bundle = ''
-        logo_bundle = ''
     else:
-        stats_bundle = """
-        <script src="/lib/d3.min.js" defer></script>
-        <script src="/stats.js" defer></script>
-        """
-        logo_bundle = """
-        <script src="/lib/p5.min.js" defer></script>
-        <script src="/logo.js" defer></script>
-        <script src="/sketch_220824a.js" defer></script>
-        """
+        stats_bundle = bundle('bundles/stats.js')
 
     return """
-    {css_bootstrap}
-    {css_main}
-    {css_stats}
-    {css_connect}
-
-    {js_client}
-    {js_window}
-    {js_flag}
-
-    <script src="/lib/jquery.min.js" defer></script>
-    <script src="/lib/bootstrap.bundle.min.js" defer></script>
-
+    {css_app}
+    {js_app}
+    {js_lib}
     {stats_bundle}
     {logo_bundle}
-    
     """.format(
-        css_bootstrap=css('res/css/bootstrap.min.css', inline),
-        css_main=css('res/css/main.css', inline),
-        css_stats=css('res/css/stats.css', inline),
-        css_connect=css('res/css/connect.css', inline),
-        js_client=js('client.js', inline),
-        js_window=js('window.js', inline),
-        js_flag=js('flag.js', inline),
+        css_app=bundle('bundles/app.css', inline),
+        js_app=bundle('bundles/app.js', inline),
+        js_lib=bundle('bundles/lib.js'),
         stats_bundle=stats_bundle,
-        logo_bundle=logo_bundle,
+        logo_bundle=bundle('bundles/logo.js'),
     )
 
 
@@ -200,7 +317,7 @@ def tab_header():
         <table>
             <tbody>
                 <tr>
-                    <td id="logo"><img id="logo-placeholder" src="/res/images/logo-placeholder.png" alt="BringYour"></td>
+                    <td id="logo">{logo_placeholder}</td>
                     <td class="expand"><div class="tab-container">{tab_html}</div></td>
                 </tr>
             </tbody>
@@ -208,7 +325,8 @@ def tab_header():
     </div>
     <div id="header-place"></div>
     """.format(
-        tab_html=''.join(tab_html_parts)
+        tab_html=''.join(tab_html_parts),
+        logo_placeholder=picture('res/images/logo-placeholder.png', 'BringYour', sizes='200px', attrs='id="logo-placeholder"'),
     )
 
 
@@ -248,8 +366,9 @@ def footer():
             <div class="copyline">Copyright {year} BringYour, Inc.</div>
         </div>
     </div>
-    <script src="/footer.js"></script>
+    {js_footer}
     """.format(
-        year=datetime.now().year
+        year=datetime.now().year,
+        js_footer=js('footer.js', False),
     )
 
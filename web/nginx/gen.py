@@ -1,5 +1,7 @@
 import uuid
 import time
+import os
+import re
 from datetime import datetime, timezone
 
 # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Last-Modified
@@ -7,3 +9,37 @@ http_last_modified = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S
 
 # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/ETag
 http_etag = uuid.uuid1().hex
+
+# deployed root -> build dir relative to web/, see web/Dockerfile
+www_builds = {
+    '/www/bringyour.com': 'bringyour.com',
+    '/www/preview.ur.io': 'build/preview.ur.io',
+    '/www/preview.ur.xyz': 'build/preview.ur.xyz',
+}
+
+
+def etags():
+    """ETags from the content hash of every deployed file, keyed by the nginx `$request_filename`.
+    nginx.conf.j2 sends them weak, since every encoding of a file shares its `$request_filename`.
+    `load_manifest` is added by webgen."""
+    root_dirpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path_etags = []
+    for www_dirpath, build_dirpath in www_builds.items():
+        for path, file in sorted(load_manifest(os.path.join(root_dirpath, build_dirpath)).items()):
+            # skip names that would need escaping in the nginx config
+            if re.fullmatch(r'[\w./@+-]+', path):
+                path_etags.append((os.path.join(www_dirpath, path), file['sha256'][:32]))
+    return path_etags
+
+
+def preloads():
+    """`Link: rel=preload` header values of every deployed webgen page, keyed by the nginx `$request_filename`.
+    `load_preloads` is added by webgen."""
+    root_dirpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path_preloads = []
+    for www_dirpath, build_dirpath in www_builds.items():
+        for path, link in sorted(load_preloads(os.path.join(root_dirpath, build_dirpath)).items()):
+            # skip names and values that would need escaping in the nginx config
+            if re.fullmatch(r'[\w./@+-]+', path) and "'" not in link:
+                path_preloads.append((os.path.join(www_dirpath, path), link))
+    return path_preloads
@@ -6,3 +6,12 @@ import os
 #   file_name
 #   build_phase
 #   build_dirpath
+#   read_build_file(path)
+#   build_file_info(path)
+#   asset_url(path)
+#   inline_css(path)
+#   picture(path, alt, sizes, attrs)
+#   bundle(name, inline)
+#   preload(path, sizes)
+#   load_manifest(dirpath)
+#   load_preloads(dirpath)
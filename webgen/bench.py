@@ -0,0 +1,390 @@
+"""webgen benchmark.
+
+Generates a synthetic site of a given size and times `webgen.py build` on it,
+once without the build cache (cold) and once with it (warm).
+
+Usage:
+  bench.py [--pages=<n>] [--templates=<n>] [--assets=<n>] [--asset-kb=<kb>] [--jobs=<n>]
+           [--repeat=<n>] [--real-tools] [--flags=<flags>] [--json=<path>] [--keep=<dir>]
+  bench.py (-h | --help)
+
+Options:
+  -h --help         Show this screen.
+  --pages=<n>       Number of blog pages [default: 200].
+  --templates=<n>   Depth of the chain of layouts that every page extends [default: 3].
+  --assets=<n>      Number of static assets, a mix of css, js and binary files [default: 60].
+  --asset-kb=<kb>   Size of each static asset in kB [default: 16].
+  --jobs=<n>        `webgen.py build --jobs` [default: 1].
+  --repeat=<n>      Number of cold and warm builds to take the median of [default: 3].
+  --real-tools      Run the installed node tools and sidecar instead of stubs that only collapse whitespace.
+  --flags=<flags>   More `webgen.py build` flags, e.g. "--precompress --fingerprint" [default: ].
+  --json=<path>     Append the results as one json line to <path>, to compare runs over time.
+  --keep=<dir>      Generate the site in <dir> and keep it, instead of a temporary dir.
+
+The site content is generated from a fixed seed, so the same options always build the same site.
+"""
+import sys
+import os
+
+from docopt import docopt
+
+
+SEED = 0
+
+# minimal stand-ins for the node tools, so the benchmark measures webgen itself
+STUB_TOOL = """#!{python}
+import sys
+
+# webgen passes the content on stdin, html-validate gets `--stdin --stdin-filename=<path>`
+args = sys.argv[1:]
+if '--version' in args:
+    print('stub')
+    sys.exit(0)
+content = sys.stdin.read()
+if {validate}:
+    sys.exit(0)
+sys.stdout.write(' '.join(content.split()))
+"""
+
+STUB_TOOLS = [
+    'html-minifier',
+    'html-validate',
+    'cleancss',
+    'uglifyjs',
+]
+
+# modeled on web/bringyour.com/gen.py
+GEN_PY = '''import os
+
+# webgen adds the following fields:
+#   page_path
+#   build_phase
+#   read_build_file(path)
+#   asset_url(path)
+#   inline_css(path)
+
+stylesheets = {stylesheets!r}
+scripts = {scripts!r}
+
+
+def css(path, inline):
+    if inline:
+        return inline_css(path)
+    else:
+        return f"""<link rel="stylesheet" href="{{asset_url(path)}}">"""
+
+
+def js(path, inline, defer=False):
+    if inline:
+        content = read_build_file(path)
+        return f"""<script>{{content}}</script>"""
+    elif defer:
+        return f"""<script src="{{asset_url(path)}}" defer></script>"""
+    else:
+        return f"""<script src="{{asset_url(path)}}"></script>"""
+
+
+def html_header():
+    return """
+    <!DOCTYPE html>
+    <html lang="en">
+    """
+
+
+def html_footer():
+    return """
+    </html>
+    """
+
+
+def app_js_css():
+    if build_phase == 'final':
+        # inline resources for the index
+        inline = (page_path == 'index')
+    else:
+        inline = False
+
+    return \'\'.join(
+        [css(path, inline) for path in stylesheets] +
+        [js(path, False, defer=True) for path in scripts]
+    )
+
+
+def footer():
+    return """
+    <div id="footer">
+        <div class="copyline">Copyright 2024 Benchmark, Inc.</div>
+    </div>
+    """
+'''
+
+WORDS = [
+    'network', 'privacy', 'secure', 'fast', 'global', 'open', 'build', 'route', 'provider', 'client',
+    'bandwidth', 'protocol', 'latency', 'region', 'connect', 'device', 'traffic', 'relay', 'peer', 'market',
+]
+
+
+def generate_site(dirpath, pages, templates, assets, asset_kb):
+    """Writes the synthetic site into `dirpath`. Returns the total size of its files in bytes."""
+    import random
+
+    rng = random.Random(SEED)
+
+    def write(path, content):
+        path = os.path.join(dirpath, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        mode = 'wb' if isinstance(content, bytes) else 'w'
+        with open(path, mode) as f:
+            f.write(content)
+
+    def text(word_count):
+        return ' '.join(rng.choice(WORDS) for _ in range(word_count))
+
+    asset_size = asset_kb * 1000
+    stylesheets = []
+    scripts = []
+    blobs = []
+    for i in range(assets):
+        kind = i % 3
+        if kind == 0:
+            path = f'res/css/site-{i}.css'
+            rules = []
+            while sum(len(rule) for rule in rules) < asset_size:
+                j = len(rules)
+                rules.append(f'.{rng.choice(WORDS)}-{j} {{\n    margin: {rng.randint(0, 32)}px;\n    color: #{rng.randrange(0x1000000):06x};\n}}\n')
+            write(path, ''.join(rules))
+            stylesheets.append(path)
+        elif kind == 1:
+            path = f'res/js/site-{i}.js'
+            functions = []
+            while sum(len(function) for function in functions) < asset_size:
+                j = len(functions)
+                functions.append(f'function {rng.choice(WORDS)}{j}(value) {{\n    return value * {rng.randint(1, 100)} + "{text(3)}"\n}}\n')
+            write(path, ''.join(functions))
+            scripts.append(path)
+        else:
+            path = f'res/data/blob-{i}.bin'
+            write(path, rng.randbytes(asset_size))
+            blobs.append(path)
+
+    # like the real sites, only a few stylesheets and scripts are on every page
+    write('gen.py', GEN_PY.format(stylesheets=stylesheets[:4], scripts=scripts[:4]))
+
+    for i in range(templates):
+        if i == 0:
+            layout = (
+                '{{ html_header() }}\n'
+                '<head>\n<meta charset="UTF-8">\n<title>{{ page_name }}</title>\n{{ app_js_css() }}\n</head>\n'
+                '<body>\n{% block nav %}{% endblock %}\n<main>{% block content %}{% endblock %}</main>\n{{ footer() }}\n</body>\n'
+                '{{ html_footer() }}\n'
+            )
+        else:
+            layout = (
+                f'{{% extends "layouts/level-{i - 1}.j2" %}}\n'
+                f'{{% block nav %}}{{{{ super() }}}}<nav class="level-{i}"><a href="/">{text(2)}</a></nav>{{% endblock %}}\n'
+            )
+        write(f'layouts/level-{i}.j2', layout)
+
+    def page(title, body):
+        if templates:
+            return (
+                f'{{% extends "layouts/level-{templates - 1}.j2" %}}\n'
+                f'{{% block content %}}<h1>{title}</h1>\n{body}{{% endblock %}}\n'
+            )
+        return f'{{{{ html_header() }}}}<body><h1>{title}</h1>\n{body}</body>{{{{ html_footer() }}}}\n'
+
+    links = []
+    for i in range(pages):
+        paragraphs = ''.join(f'<p>{text(60)}</p>\n' for _ in range(5))
+        if blobs:
+            paragraphs += f'<a href="{{{{ asset_url(\'{blobs[i % len(blobs)]}\') }}}}">download</a>\n'
+        write(f'blog/post-{i:05d}.html.j2', page(text(4), paragraphs))
+        links.append(f'<li><a href="/blog/post-{i:05d}">post {i}</a></li>')
+    write('index.html.j2', page('index', f'<ul>\n{"".join(links)}\n</ul>\n'))
+
+    total_size = 0
+    for walk_dirpath, _, walk_filenames in os.walk(dirpath):
+        for walk_filename in walk_filenames:
+            total_size += os.path.getsize(os.path.join(walk_dirpath, walk_filename))
+    return total_size
+
+
+def write_stub_tools(stubs_dirpath):
+    os.makedirs(stubs_dirpath, exist_ok=True)
+    for tool in STUB_TOOLS:
+        path = os.path.join(stubs_dirpath, tool)
+        with open(path, 'w') as f:
+            f.write(STUB_TOOL.format(python=sys.executable, validate=(tool == 'html-validate')))
+        os.chmod(path, 0o755)
+
+
+def run_build(site_dirpath, args, env, log_path):
+    """Runs `webgen.py build` in a new process. Returns (wall seconds, peak rss in bytes, output file count, output bytes)."""
+    import subprocess
+    import time
+
+    webgen_py_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webgen.py')
+    gen_py_path = os.path.join(site_dirpath, 'gen.py')
+
+    subprocess.run(
+        [sys.executable, webgen_py_path, 'clean', gen_py_path],
+        stdout=subprocess.DEVNULL,
+        check=True
+    )
+
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        p = subprocess.Popen(
+            [sys.executable, webgen_py_path, 'build'] + args + [gen_py_path],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env=env
+        )
+        # the rusage of this one build, rather than the max over every child so far
+        _, status, rusage = os.wait4(p.pid, 0)
+        seconds = time.perf_counter() - start
+    p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode != 0:
+        print(f'Error: the build failed, see "{log_path}"\n', file=sys.stderr)
+        sys.exit(1)
+
+    file_count = 0
+    file_size = 0
+    for walk_dirpath, _, walk_filenames in os.walk(os.path.join(site_dirpath, 'build')):
+        for walk_filename in walk_filenames:
+            file_count += 1
+            file_size += os.path.getsize(os.path.join(walk_dirpath, walk_filename))
+    # linux reports ru_maxrss in kB
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return seconds, peak_rss, file_count, file_size
+
+
+def git_commit():
+    import subprocess
+
+    p = subprocess.run(
+        ['git', 'rev-parse', '--short', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True
+    )
+    return p.stdout.strip() if p.returncode == 0 else None
+
+
+def bench(args):
+    import json
+    import shutil
+    import statistics
+    import tempfile
+    import time
+
+    pages = int(args['--pages'])
+    templates = int(args['--templates'])
+    assets = int(args['--assets'])
+    asset_kb = int(args['--asset-kb'])
+    jobs = int(args['--jobs'])
+    repeat = int(args['--repeat'])
+    real_tools = args['--real-tools']
+    flags = args['--flags'].split()
+    if repeat < 1:
+        print('Error: --repeat must be at least 1\n', file=sys.stderr)
+        sys.exit(1)
+
+    if args['--keep']:
+        work_dirpath = args['--keep']
+        if os.path.exists(work_dirpath):
+            print(f'Error: "{work_dirpath}" already exists\n', file=sys.stderr)
+            sys.exit(1)
+        os.makedirs(work_dirpath)
+    else:
+        work_dirpath = tempfile.mkdtemp(prefix='webgen-bench.')
+    site_dirpath = os.path.join(work_dirpath, 'site')
+
+    try:
+        site_size = generate_site(site_dirpath, pages, templates, assets, asset_kb)
+        sys.stdout.write(
+            f'Generated {pages} pages, {templates} layouts and {assets} assets of {asset_kb} kB '
+            f'({site_size / 1e6:.1f} MB) in "{site_dirpath}"\n'
+        )
+
+        env = dict(os.environ)
+        build_args = [f'--jobs={jobs}'] + flags
+        if not real_tools:
+            stubs_dirpath = os.path.join(work_dirpath, 'stubs')
+            write_stub_tools(stubs_dirpath)
+            env['PATH'] = os.pathsep.join([stubs_dirpath, env.get('PATH', '')])
+            build_args.append('--no-sidecar')
+
+        runs = {
+            'cold': [],
+            'warm': [],
+        }
+        for i in range(repeat):
+            for mode in ['cold', 'warm']:
+                if mode == 'cold':
+                    shutil.rmtree(os.path.join(site_dirpath, '.webgen-cache'), ignore_errors=True)
+                log_path = os.path.join(work_dirpath, f'build-{mode}-{i}.log')
+                seconds, peak_rss, file_count, file_size = run_build(site_dirpath, build_args, env, log_path)
+                run = {
+                    'seconds': seconds,
+                    'files_per_second': file_count / seconds,
+                    'mb_per_second': site_size / 1e6 / seconds,
+                    'peak_rss_mb': peak_rss / 1e6,
+                    'files': file_count,
+                    'output_mb': file_size / 1e6,
+                }
+                runs[mode].append(run)
+                sys.stdout.write(
+                    f'[{mode} {i + 1}/{repeat}] {file_count} files in {seconds:.2f}s, '
+                    f'{run["files_per_second"]:.1f} files/s, {run["mb_per_second"]:.2f} MB/s, '
+                    f'peak {run["peak_rss_mb"]:.1f} MB\n'
+                )
+                sys.stdout.flush()
+
+        medians = {
+            mode: {
+                key: statistics.median(run[key] for run in mode_runs)
+                for key in mode_runs[0]
+            }
+            for mode, mode_runs in runs.items()
+        }
+        for mode, median in medians.items():
+            sys.stdout.write(
+                f'{mode} median: {median["seconds"]:.2f}s, {median["files_per_second"]:.1f} files/s, '
+                f'{median["mb_per_second"]:.2f} MB/s, peak {median["peak_rss_mb"]:.1f} MB\n'
+            )
+
+        if args['--json']:
+            import platform
+
+            record = {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'site': {
+                    'pages': pages,
+                    'templates': templates,
+                    'assets': assets,
+                    'asset_kb': asset_kb,
+                    'size_mb': site_size / 1e6,
+                },
+                'build_args': build_args,
+                'tools': 'real' if real_tools else 'stub',
+                'median': medians,
+                'runs': runs,
+            }
+            with open(args['--json'], 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+            sys.stdout.write(f'Appended results to "{args["--json"]}"\n')
+    finally:
+        if not args['--keep']:
+            shutil.rmtree(work_dirpath, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    bench(args)
@@ -0,0 +1,135 @@
+// Long-lived node process that runs the webgen minifiers and validator in-process,
+// so a build pays node start-up and module loading once instead of once per file.
+//
+// The protocol is newline-delimited JSON on stdin/stdout. On start the sidecar writes
+//   {"ready": true, "versions": {"html-minifier": "4.0.0", ...}}
+// or {"ready": false, "error": "..."} when a tool cannot be loaded.
+// Each request line
+//   {"id": 1, "tool": "cleancss", "filename": "main.css", "input": "...", "options": {...}}
+// gets exactly one response line, in request order, so requests may be pipelined
+//   {"id": 1, "ok": true, "output": "...", "messages": []}
+//
+// The global tool packages are found through NODE_PATH (`npm root -g`).
+
+'use strict'
+
+const fs = require('fs')
+const path = require('path')
+const readline = require('readline')
+
+
+function load(names) {
+    for (const name of names) {
+        try {
+            return { name: name, module: require(name) }
+        } catch (e) {
+            if (e.code !== 'MODULE_NOT_FOUND') {
+                throw e
+            }
+        }
+    }
+    throw new Error(`Cannot find any of ${names.join(', ')}`)
+}
+
+function version(name) {
+    let dirpath = path.dirname(require.resolve(name))
+    while (dirpath !== path.dirname(dirpath)) {
+        const packagePath = path.join(dirpath, 'package.json')
+        if (fs.existsSync(packagePath)) {
+            const pkg = JSON.parse(fs.readFileSync(packagePath, 'utf8'))
+            if (pkg.version) {
+                return pkg.version
+            }
+        }
+        dirpath = path.dirname(dirpath)
+    }
+    return 'unknown'
+}
+
+
+function loadTools() {
+    const htmlMinifier = load(['html-minifier'])
+    const htmlValidate = load(['html-validate'])
+    // clean-css-cli and html-minifier keep their own copy of clean-css
+    const cleanCss = load(['clean-css', 'clean-css-cli/node_modules/clean-css', 'html-minifier/node_modules/clean-css'])
+    const uglifyJs = load(['uglify-js'])
+
+    const validators = new Map()
+
+    return {
+        versions: {
+            'html-minifier': version(htmlMinifier.name),
+            'html-validate': version(htmlValidate.name),
+            'cleancss': version(cleanCss.name),
+            'uglifyjs': version(uglifyJs.name),
+        },
+        'html-minifier': async (request) => {
+            const output = await htmlMinifier.module.minify(request.input, request.options)
+            return { ok: true, output: output, messages: [] }
+        },
+        'html-validate': async (request) => {
+            const key = JSON.stringify(request.options)
+            if (!validators.has(key)) {
+                validators.set(key, new htmlValidate.module.HtmlValidate(request.options))
+            }
+            const report = await validators.get(key).validateString(request.input, request.filename)
+            const messages = []
+            for (const result of report.results) {
+                for (const message of result.messages) {
+                    const severity = message.severity === 2 ? 'error' : 'warning'
+                    messages.push(`${request.filename}:${message.line}:${message.column}  ${severity}  ${message.message}  ${message.ruleId}`)
+                }
+            }
+            return { ok: report.valid, output: null, messages: messages }
+        },
+        'cleancss': async (request) => {
+            const result = new cleanCss.module(request.options).minify(request.input)
+            return { ok: result.errors.length === 0, output: result.styles, messages: result.errors.concat(result.warnings) }
+        },
+        'uglifyjs': async (request) => {
+            const result = uglifyJs.module.minify(request.input, request.options)
+            if (result.error) {
+                return { ok: false, output: null, messages: [`${request.filename}: ${result.error.message}`] }
+            }
+            return { ok: true, output: result.code, messages: result.warnings || [] }
+        },
+    }
+}
+
+
+function write(message) {
+    process.stdout.write(JSON.stringify(message) + '\n')
+}
+
+async function main() {
+    let tools
+    try {
+        tools = loadTools()
+    } catch (e) {
+        write({ ready: false, error: e.message })
+        return
+    }
+    write({ ready: true, versions: tools.versions })
+
+    const lines = readline.createInterface({ input: process.stdin, crlfDelay: Infinity })
+    for await (const line of lines) {
+        if (!line) {
+            continue
+        }
+        const request = JSON.parse(line)
+        let response
+        try {
+            const tool = tools[request.tool]
+            if (!tool) {
+                throw new Error(`Unknown tool "${request.tool}"`)
+            }
+            response = await tool(request)
+        } catch (e) {
+            response = { ok: false, output: null, messages: [`${request.filename}: ${e.message}`] }
+        }
+        response.id = request.id
+        write(response)
+    }
+}
+
+main()
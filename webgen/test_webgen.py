@@ -0,0 +1,108 @@
+"""webgen tests.
+
+Run with `python -m unittest test_webgen` from this dir. The builds run without minify and validate,
+so they need no node tools.
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import webgen
+
+
+def write_site(dirpath, files):
+    for path, content in files.items():
+        file_path = os.path.join(dirpath, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as f:
+            f.write(content)
+
+
+def read_build_file(dirpath, path):
+    with open(os.path.join(dirpath, 'build', path), 'r') as f:
+        return f.read()
+
+
+class BuildTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dirpath = tmp.name
+
+    def build(self, **kwargs):
+        webgen.build(self.dirpath, minify=False, validate=False, sidecar=False, cache=False, **kwargs)
+
+    def test_single_pass_layout_reads_page_path(self):
+        write_site(self.dirpath, {
+            'gen.py': 'def nav():\n    return f"<nav>{page_path}</nav>"\n',
+            'layouts/base.j2': '<html><body>{{ nav() }}{% block content %}{% endblock %}</body></html>',
+            'index.html.j2': '{% extends "layouts/base.j2" %}{% block content %}index{% endblock %}',
+            'blog/post.html.j2': '{% extends "layouts/base.j2" %}{% block content %}post{% endblock %}',
+            'robots.txt.j2': 'User-agent: *',
+        })
+        self.build(single_pass=True)
+
+        self.assertIn('<nav>index</nav>', read_build_file(self.dirpath, 'index.html'))
+        self.assertIn('<nav>blog/post</nav>', read_build_file(self.dirpath, 'blog/post.html'))
+        self.assertEqual(read_build_file(self.dirpath, 'robots.txt'), 'User-agent: *')
+        # the layout only renders as part of the pages
+        self.assertFalse(os.path.exists(os.path.join(self.dirpath, 'build', 'layouts', 'base')))
+
+    def test_serve_update_layout_rerenders_pages(self):
+        write_site(self.dirpath, {
+            'gen.py': 'def nav():\n    return f"<nav>{page_path}</nav>"\n',
+            'layouts/base.j2': '<html><body>{{ nav() }}{% block content %}{% endblock %}</body></html>',
+            'index.html.j2': '{% extends "layouts/base.j2" %}{% block content %}index{% endblock %}',
+        })
+        site = webgen.build(self.dirpath, minify=False, validate=False, sidecar=False, cache=False, single_pass=True, serve=True)
+        self.addCleanup(site.close)
+
+        write_site(self.dirpath, {
+            'layouts/base.j2': '<html><body><main>{{ nav() }}</main>{% block content %}{% endblock %}</body></html>',
+        })
+        self.assertEqual(site.update(['layouts/base.j2']), ['index.html.j2'])
+        self.assertIn('<main><nav>index</nav></main>', read_build_file(self.dirpath, 'index.html'))
+
+
+class PackedSiteTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dirpath = tmp.name
+        write_site(self.dirpath, {
+            'gen.py': '',
+            'index.html.j2': '<html><body>' + 'hello webgen ' * 200 + '</body></html>',
+        })
+        webgen.build(self.dirpath, minify=False, validate=False, sidecar=False, cache=False, compress_outputs=True, pack=True)
+        build_root_dirpath = os.path.dirname(os.path.realpath(os.path.join(self.dirpath, 'build')))
+        self.site = webgen.PackedSite(os.path.join(build_root_dirpath, webgen.PACK_FILENAME))
+        self.addCleanup(self.site.close)
+
+    def test_etag_per_encoding(self):
+        import gzip
+
+        identity, content_type, identity_etag, coding = self.site.get('index.html')
+        self.assertEqual(content_type, 'text/html; charset=utf-8')
+        self.assertIsNone(coding)
+        self.assertEqual(bytes(identity), read_build_file(self.dirpath, 'index.html').encode('utf-8'))
+
+        etags = {identity_etag}
+        for encoding in ['gzip', 'br']:
+            content, _, etag, coding = self.site.get('index.html', [encoding])
+            self.assertEqual(coding, encoding)
+            etags.add(etag)
+            if encoding == 'gzip':
+                self.assertEqual(gzip.decompress(content), bytes(identity))
+        self.assertEqual(len(etags), 3)
+
+    def test_close_with_content_referenced(self):
+        content = self.site.get('index.html')[0]
+        self.site.close()
+        self.assertTrue(bytes(content).startswith(b'<html>'))
+
+
+if __name__ == '__main__':
+    unittest.main()
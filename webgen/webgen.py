@@ -1,14 +1,50 @@
 """Naval Fate.
 
 Usage:
-  webgen.py clean <gen.py>
-  webgen.py build <gen.py>
+  webgen.py clean [--store=<dir>] <gen.py>...
+  webgen.py build [--jobs=<n>] [--no-sidecar] [--no-cache] [--materialize=<mode>] [--store=<dir>]
+                  [--precompress] [--fingerprint] [--single-pass] [--critical-css]
+                  [--purge-css] [--images] [--subset-fonts] [--bundle] [--budgets] [--pack] [--check-links] [--profile] [--keep=<n>] <gen.py>...
+  webgen.py rollback [--to=<build>] <gen.py>...
+  webgen.py precompile <gen.py>...
+  webgen.py delta [--from=<build>] [--out=<path>] <gen.py>
+  webgen.py serve [--port=<port>] [--jobs=<n>] [--minify] [--validate] <gen.py>
   webgen.py (-h | --help)
   webgen.py --version
 
 Options:
   -h --help     Show this screen.
   --version     Show version.
+  --jobs=<n>    Number of build tasks to run concurrently [default: 1].
+  --no-sidecar  Run one node process per file instead of the node sidecar.
+  --no-cache    Do not read or write the build cache in <site>/.webgen-cache.
+  --materialize=<mode>  How static assets are placed in the build: `copy`, or
+                `auto` to try a reflink, then a hardlink into the store, then a copy [default: copy].
+  --store=<dir>  Content-addressed store for `--materialize=auto` hardlinks,
+                shared by every site that names it (default: <site>/.webgen-cache/store).
+  --precompress  Write .br and .gz siblings of text outputs for nginx `brotli_static`/`gzip_static`.
+  --fingerprint  Add `name.<hash>.ext` copies of css, js, fonts and images for gen `asset_url()`.
+  --single-pass  Render templates once, in the final phase, after the static files are processed.
+  --critical-css  Reduce each gen `inline_css()` stylesheet to the rules the page uses
+                and load the full stylesheet asynchronously.
+  --purge-css   Remove the rules of the gen `purge_css` stylesheets that no content file can match.
+  --images      Losslessly recompress png and jpeg, and write the avif/webp variants
+                of the gen `images` for `picture()`.
+  --subset-fonts  Add subsets of the fonts of the gen `subset_fonts` stylesheets
+                with just the text that the content files use.
+  --bundle      Concatenate the files of each gen `bundles` entry into one file for `bundle()`.
+  --budgets     Fail the build when a page goes over the gen `budgets`, the weights are always in webgen-budget.json.
+  --pack        Also write the build as one mmap-able file, webgen-site.pack next to the manifest, see `PackedSite`.
+  --check-links  Report the dangling links of the build and the files nothing links to, in webgen-links.json.
+  --profile     Also write a cProfile of template rendering next to the build's webgen-profile.json.
+  --keep=<n>    Number of newest builds to keep, the linked build is always kept.
+                Older builds are deleted in the background [default: 5].
+  --to=<build>  Build dir to link on `rollback`, e.g. build.1700000000 (default: the build before the linked one).
+  --from=<build>  Build dir to compare the linked build with on `delta` (default: the build linked before it).
+  --out=<path>  Write a tar of the delta and the added and changed files, `-` for stdout, `.zst` to compress.
+  --port=<port>  Port of the `serve` dev server on localhost [default: 8000].
+  --minify      Minify outputs in `serve`, which skips it for a faster rebuild.
+  --validate    Validate outputs in `serve`, which skips it for a faster rebuild.
 
 """
 import sys
@@ -17,7 +53,7 @@ import os
 from docopt import docopt
 
 
-def clean(dirpath):
+def clean(dirpath, store_dirpath=None):
     import shutil
 
     build_dirnames = [
@@ -35,208 +71,3040 @@ def clean(dirpath):
         elif os.path.isdir(build_dirpath):
             shutil.rmtree(build_dirpath)
 
+    if store_dirpath is not None and os.path.isdir(store_dirpath):
+        pruned_count = Materializer.prune(store_dirpath)
+        sys.stdout.write(f'Pruned {pruned_count} unreferenced files from "{store_dirpath}"\n')
 
-def build(dirpath, minify=True, validate=True):
+
+def build_key(filename):
+    """The order of a `build.<timestamp>` or `build.<timestamp>.<n>` dir name, or `None` for any other name."""
+    import re
+
+    m = re.fullmatch(r'build\.(\d+)(?:\.(\d+))?', filename)
+    if m is None:
+        return None
+    return (int(m.group(1)), int(m.group(2) or 0))
+
+
+def list_builds(dirpath):
+    """The build dir names of the site at `dirpath`, oldest first."""
+    return sorted(
+        (
+            filename
+            for filename in os.listdir(dirpath)
+            if build_key(filename) is not None and os.path.isdir(os.path.join(dirpath, filename))
+        ),
+        key=build_key
+    )
+
+
+def linked_build(dirpath):
+    """The build dir name that the `build` link of the site at `dirpath` points to, or `None`."""
+    build_linkpath = os.path.join(dirpath, 'build')
+    if not os.path.islink(build_linkpath):
+        return None
+    return os.path.normpath(os.readlink(build_linkpath)).split(os.sep, 1)[0]
+
+
+def publish(dirpath, build_root_dirname):
+    """Points the `build` link of the site at `dirpath` to `build_root_dirname/build`.
+    The new link is made under a temp name and renamed over the old one,
+    so a server following `build` never finds it missing."""
+    build_linkpath = os.path.join(dirpath, 'build')
+    tmp_linkpath = os.path.join(dirpath, f'build.{os.getpid()}.link')
+    if os.path.lexists(tmp_linkpath):
+        os.remove(tmp_linkpath)
+    os.symlink(os.path.join(build_root_dirname, 'build'), tmp_linkpath, target_is_directory=True)
+    os.replace(tmp_linkpath, build_linkpath)
+
+
+def prune_builds(dirpath, keep):
+    """Deletes all but the newest `keep` builds and the linked build of the site at `dirpath`.
+    The builds are renamed out of the way at once and deleted by a detached process,
+    so the caller does not wait for the deletion. Returns the number of builds pruned."""
     import subprocess
+
+    live_build_dirname = linked_build(dirpath)
+    build_dirnames = list_builds(dirpath)
+    pruned_dirnames = [
+        build_dirname
+        for build_dirname in build_dirnames[:max(0, len(build_dirnames) - keep)]
+        if build_dirname != live_build_dirname
+    ]
+
+    trash_dirpaths = []
+    for build_dirname in pruned_dirnames:
+        trash_dirpath = os.path.join(dirpath, f'{build_dirname}.trash')
+        os.rename(os.path.join(dirpath, build_dirname), trash_dirpath)
+        trash_dirpaths.append(trash_dirpath)
+    # and whatever an earlier deletion did not get to
+    trash_dirpaths.extend(
+        os.path.join(dirpath, filename)
+        for filename in os.listdir(dirpath)
+        if filename.startswith('build.') and filename.endswith('.trash') and os.path.join(dirpath, filename) not in trash_dirpaths
+    )
+
+    if trash_dirpaths:
+        subprocess.Popen(
+            [sys.executable, '-c', 'import shutil, sys\nfor path in sys.argv[1:]: shutil.rmtree(path, ignore_errors=True)'] + trash_dirpaths,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+    return len(pruned_dirnames)
+
+
+def rollback(dirpath, to=None):
+    """Links the build before the linked one, or the build `to`, e.g. `build.1700000000`."""
+    build_dirnames = [
+        build_dirname
+        for build_dirname in list_builds(dirpath)
+        # only builds that finished have a manifest
+        if os.path.isfile(os.path.join(dirpath, build_dirname, MANIFEST_FILENAME))
+    ]
+    live_build_dirname = linked_build(dirpath)
+
+    if to is not None:
+        if to not in build_dirnames:
+            print(f'Error: "{os.path.join(dirpath, to)}" is not a finished build\n', file=sys.stderr)
+            sys.exit(1)
+        build_dirname = to
+    else:
+        earlier_dirnames = [
+            build_dirname
+            for build_dirname in build_dirnames
+            if live_build_dirname is None or build_key(live_build_dirname) is None or build_key(build_dirname) < build_key(live_build_dirname)
+        ]
+        if not earlier_dirnames:
+            print(f'Error: "{dirpath}" has no build before {live_build_dirname}\n', file=sys.stderr)
+            sys.exit(1)
+        build_dirname = earlier_dirnames[-1]
+
+    publish(dirpath, build_dirname)
+    sys.stdout.write(f'Linked "{os.path.join(dirpath, "build")}" to {build_dirname}, was {live_build_dirname}\n')
+
+
+class TaskLog:
+    """Buffers the output of one task so that concurrent tasks never interleave lines.
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append((sys.stdout, text))
+
+    def error(self, text):
+        self.parts.append((sys.stderr, text))
+
+    def flush(self):
+        pass
+
+    def dump(self):
+        for stream, text in self.parts:
+            stream.write(text)
+        self.parts = []
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class Task:
+    def __init__(self, name, fn, deps=()):
+        self.name = name
+        # `fn(log)`
+        self.fn = fn
+        self.deps = list(deps)
+        self.log = TaskLog()
+
+
+def run_tasks(tasks, jobs=1, profile=None, executor=None):
+    """Runs `tasks` on a pool of `jobs` threads, starting each task once its deps are done.
+
+    Ready tasks are started in list order and their logs are written in list order,
+    so the output is the same for any number of jobs.
+    With a `Profile`, each task is timed as a `task` span.
+    `executor` is a thread pool shared with other sites, at most `jobs` of these tasks are queued on it at once.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            return run_tasks(tasks, jobs=jobs, profile=profile, executor=executor)
+
+    def run(task):
+        if profile is None:
+            return task.fn(task.log)
+        with profile.span('task', task.name):
+            return task.fn(task.log)
+
+    order = {task: i for i, task in enumerate(tasks)}
+    remaining = {task: set(task.deps) for task in tasks}
+    dependents = {task: [] for task in tasks}
+    for task in tasks:
+        for dep in task.deps:
+            dependents[dep].append(task)
+
+    ready = [task for task in tasks if not remaining[task]]
+    done = set()
+    flushed = 0
+    failure = None
+
+    running = {}
+    while True:
+        while ready and len(running) < max(1, jobs) and failure is None:
+            task = ready.pop(0)
+            running[executor.submit(run, task)] = task
+        if not running:
+            break
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in sorted(finished, key=lambda future: order[running[future]]):
+            task = running.pop(future)
+            done.add(task)
+            e = future.exception()
+            if e is not None:
+                if failure is None:
+                    failure = e
+                continue
+            for dependent in dependents[task]:
+                remaining[dependent].discard(task)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+        ready.sort(key=lambda task: order[task])
+
+        while flushed < len(tasks) and tasks[flushed] in done:
+            tasks[flushed].log.dump()
+            flushed += 1
+
+    if failure is not None:
+        # write out whatever finished so the failing task's output is visible
+        for task in tasks[flushed:]:
+            if task in done:
+                task.log.dump()
+        raise failure
+    if flushed < len(tasks):
+        raise RuntimeError(f'Task dependency cycle at "{tasks[flushed].name}"')
+
+
+PROFILE_FILENAME = 'webgen-profile.json'
+RENDER_PROFILE_FILENAME = 'webgen-render.prof'
+
+
+class Profile:
+    """Timings, byte counts and counters of one build, written as a Chrome trace
+    (chrome://tracing, https://ui.perfetto.dev).
+
+    Each `span` is a complete event whose `cat` is the build stage, e.g. `render` or `minify`,
+    and whose `args` hold its `bytes_in`/`bytes_out`.
+    """
+
+    def __init__(self):
+        import threading
+        import time
+
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.events = []
+        self.counters = {}
+
+    def span(self, cat, name, **args):
+        """A context manager that times its block. It yields `args`, which the block can add to."""
+        import contextlib
+        import threading
+        import time
+
+        @contextlib.contextmanager
+        def timed():
+            start = time.perf_counter()
+            try:
+                yield args
+            finally:
+                end = time.perf_counter()
+                event = {
+                    'name': name,
+                    'cat': cat,
+                    'ph': 'X',
+                    'ts': round((start - self.start) * 1e6),
+                    'dur': round((end - start) * 1e6),
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': args,
+                }
+                with self.lock:
+                    self.events.append(event)
+
+        return timed()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stages(self):
+        """Stage -> {'count', 'seconds', 'bytes_in', 'bytes_out'}, in the order the stages started.
+        Task spans overlap the stages they run, so they are not a stage."""
+        stages = {}
+        for event in sorted(self.events, key=lambda event: event['ts']):
+            if event['cat'] == 'task':
+                continue
+            stage = stages.setdefault(event['cat'], {'count': 0, 'seconds': 0, 'bytes_in': 0, 'bytes_out': 0})
+            stage['count'] += 1
+            stage['seconds'] += event['dur'] / 1e6
+            stage['bytes_in'] += event['args'].get('bytes_in', 0)
+            stage['bytes_out'] += event['args'].get('bytes_out', 0)
+        return stages
+
+    def write(self, path):
+        write_json(path, {
+            'traceEvents': self.events,
+            'displayTimeUnit': 'ms',
+            'counters': self.counters,
+            'stages': self.stages(),
+        })
+
+    def summary(self):
+        """One line per stage and one for the counters.
+        Stage seconds are summed over concurrent tasks, so they can add up to more than the wall time."""
+        def kb(size):
+            return f'{size / 1e3:.1f} kB'
+
+        lines = []
+        for cat, stage in self.stages().items():
+            line = f'  {cat:<12} {stage["count"]:>5} x {stage["seconds"]:8.3f}s'
+            if stage['bytes_in'] or stage['bytes_out']:
+                line += f'  {kb(stage["bytes_in"])} -> {kb(stage["bytes_out"])}'
+            lines.append(line + '\n')
+        if self.counters:
+            counters = ', '.join(f'{count} {name}' for name, count in sorted(self.counters.items()))
+            lines.append(f'  {counters}\n')
+        return ''.join(lines)
+
+
+def write_file(path, content):
+    """Writes the text or bytes `content` to a temp file next to `path` and renames it over `path`,
+    so no one sees a partial file and a failed write leaves nothing behind.
+    A hardlink at `path`, e.g. into the store, is replaced rather than written through."""
+    import threading
+
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json(path, value):
+    import json
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, json.dumps(value, indent=4, sort_keys=True))
+
+
+CACHE_DIRNAME = '.webgen-cache'
+
+
+class Cache:
+    """Content-addressed build cache, kept next to the site in `CACHE_DIRNAME`.
+
+    `objects/` holds output content by its sha256.
+    `keys/` maps a hash of (tool, tool version, options, input hash) to an output.
+    """
+
+    def __init__(self, cache_dirpath):
+        import threading
+
+        self.cache_dirpath = cache_dirpath
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash(content):
+        import hashlib
+
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+
+    @staticmethod
+    def key(*parts):
+        import json
+
+        return Cache.hash(json.dumps(parts, sort_keys=True))
+
+    def _path(self, kind, h):
+        return os.path.join(self.cache_dirpath, kind, h[:2], h)
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, content)
+
+    def object_path(self, h):
+        return self._path('objects', h)
+
+    def put_object(self, content):
+        """Returns the hash of `content`."""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        h = Cache.hash(content)
+        path = self.object_path(h)
+        if not os.path.exists(path):
+            self._write(path, content)
+        return h
+
+    def get(self, key, binary=False):
+        """Returns the cached output text (or bytes, with `binary`) for `key`, or `None`."""
+        import json
+
+        try:
+            with open(self._path('keys', key), 'r') as f:
+                entry = json.load(f)
+            with open(self.object_path(entry['output']), 'rb') as f:
+                output = f.read()
+            if not binary:
+                output = output.decode('utf-8')
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return output
+
+    def put(self, key, output):
+        import json
+
+        self._write(self._path('keys', key), json.dumps({
+            'output': self.put_object(output),
+        }).encode('utf-8'))
+
+    def write_json(self, name, value):
+        write_json(os.path.join(self.cache_dirpath, name), value)
+
+
+TEMPLATE_BUNDLE_FILENAME = 'templates.zip'
+
+
+class TemplateCache:
+    """Jinja bytecode cache in `templates/` of the build cache, keyed by template name and source hash,
+    so a warm build or a rebuild in `serve` loads each unchanged template without compiling it.
+
+    The `precompile` bundle, `TEMPLATE_BUNDLE_FILENAME` in the build cache, is looked up first.
+    """
+
+    def __init__(self, cache_dirpath, profile=None):
+        import threading
+
+        self.cache_dirpath = cache_dirpath
+        self.profile = profile
+        self.lock = threading.Lock()
+        self.bundle = None
+        bundle_path = os.path.join(cache_dirpath, TEMPLATE_BUNDLE_FILENAME)
+        if os.path.isfile(bundle_path):
+            import zipfile
+
+            self.bundle = zipfile.ZipFile(bundle_path)
+
+    @staticmethod
+    def key(name, source):
+        return Cache.key('template', name, Cache.hash(source))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dirpath, 'templates', key[:2], key)
+
+    def _count(self, hit):
+        if self.profile is not None:
+            self.profile.count(f'template cache {"hits" if hit else "misses"}')
+
+    def get_bucket(self, environment, name, filename, source):
+        from jinja2.bccache import Bucket
+
+        bucket = Bucket(environment, TemplateCache.key(name, source), Cache.hash(source))
+        if self.bundle is not None:
+            try:
+                with self.lock:
+                    bucket.bytecode_from_string(self.bundle.read(bucket.key))
+            except KeyError:
+                pass
+        if bucket.code is None:
+            try:
+                with open(self._path(bucket.key), 'rb') as f:
+                    bucket.load_bytecode(f)
+            except OSError:
+                pass
+        # the bucket drops bytecode of another jinja or python version
+        self._count(bucket.code is not None)
+        return bucket
+
+    def set_bucket(self, bucket):
+        path = self._path(bucket.key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, bucket.bytecode_to_string())
+
+    def close(self):
+        if self.bundle is not None:
+            self.bundle.close()
+
+
+def template_env(dirpath, bytecode_cache=None):
+    """The jinja environment of the templates of the site at `dirpath`."""
+    from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+    return Environment(
+        loader=FileSystemLoader(dirpath),
+        autoescape=select_autoescape(),
+        bytecode_cache=bytecode_cache
+    )
+
+
+def precompile(dirpath):
+    """Compiles every `.j2` template of the site at `dirpath` into `TEMPLATE_BUNDLE_FILENAME` in its build cache,
+    one bytecode entry per template keyed like `TemplateCache`. Builds load the bundled templates without compiling them."""
+    import glob
+    import zipfile
+
+    from jinja2.bccache import Bucket
+
+    jinja_env = template_env(dirpath)
+    bundle_path = os.path.join(dirpath, CACHE_DIRNAME, TEMPLATE_BUNDLE_FILENAME)
+    os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+    tmp_path = f'{bundle_path}.{os.getpid()}.tmp'
+    template_count = 0
+    try:
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            # sorted, so the same sources give the same bundle
+            for path in sorted(glob.glob(os.path.join('**', '*.j2'), root_dir=dirpath, recursive=True)):
+                top_dirname = path.split(os.sep, 1)[0]
+                if top_dirname.startswith('build') or top_dirname == CACHE_DIRNAME:
+                    continue
+                name = path.replace(os.sep, '/')
+                source, filename, _ = jinja_env.loader.get_source(jinja_env, name)
+                bucket = Bucket(jinja_env, TemplateCache.key(name, source), Cache.hash(source))
+                bucket.code = jinja_env.compile(source, name, filename)
+                info = zipfile.ZipInfo(bucket.key, date_time=(1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                bundle.writestr(info, bucket.bytecode_to_string())
+                template_count += 1
+        os.replace(tmp_path, bundle_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    sys.stdout.write(f'Compiled {template_count} templates into "{bundle_path}"\n')
+
+
+# linux `_IOW(0x94, 9, int)`, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+class Materializer:
+    """Places static assets into the build with as little data copying as possible.
+
+    `copy` always copies. `auto` tries a reflink (FICLONE on linux, clonefile on macos),
+    then a hardlink to the file's content in `store_dirpath`, then falls back to a copy.
+    Store files are read-only since every build that links them shares the inode.
+    """
+
+    def __init__(self, mode, store_dirpath, hashes_path=None):
+        import threading
+
+        self.mode = mode
+        self.store_dirpath = store_dirpath
+        self.hashes_path = hashes_path
+        self.lock = threading.Lock()
+        self.reflink = (mode == 'auto')
+        self.hardlink = (mode == 'auto')
+        # (path, size, mtime, inode) -> sha256, so unchanged sources are not re-read every build
+        self.hashes = {}
+        if hashes_path is not None:
+            import json
+            try:
+                with open(hashes_path, 'r') as f:
+                    self.hashes = json.load(f)
+            except (OSError, ValueError):
+                pass
+        self.counts = {
+            'reflink': 0,
+            'hardlink': 0,
+            'copy': 0,
+        }
+
+    def materialize(self, src_path, dst_path):
+        """Returns how the file was placed: `reflink`, `hardlink` or `copy`."""
+        import shutil
+
+        if self.reflink and self._reflink(src_path, dst_path):
+            method = 'reflink'
+        elif self.hardlink and self._hardlink(src_path, dst_path):
+            method = 'hardlink'
+        else:
+            shutil.copyfile(src_path, dst_path)
+            method = 'copy'
+        with self.lock:
+            self.counts[method] += 1
+        return method
+
+    def _reflink(self, src_path, dst_path):
+        import errno
+
+        try:
+            if sys.platform == 'darwin':
+                import ctypes
+
+                libc = ctypes.CDLL(None, use_errno=True)
+                if libc.clonefile(os.fsencode(src_path), os.fsencode(dst_path), 0) == 0:
+                    return True
+                e = OSError(ctypes.get_errno(), 'clonefile')
+            else:
+                import fcntl
+
+                with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+                    try:
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                        return True
+                    except OSError as ioctl_e:
+                        e = ioctl_e
+                os.remove(dst_path)
+        except (OSError, AttributeError) as open_e:
+            e = open_e
+        if getattr(e, 'errno', None) in [errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, None]:
+            # the filesystem cannot clone, so stop trying
+            self.reflink = False
+        return False
+
+    def _hash(self, src_path):
+        stat = os.stat(src_path)
+        memo_key = f'{os.path.abspath(src_path)}:{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}'
+        with self.lock:
+            h = self.hashes.get(memo_key)
+        if h is None:
+            h = hash_file(src_path)
+            with self.lock:
+                self.hashes[memo_key] = h
+        return h
+
+    def _hardlink(self, src_path, dst_path):
+        import shutil
+
+        h = self._hash(src_path)
+        store_path = os.path.join(self.store_dirpath, h[:2], h)
+        try:
+            if not os.path.exists(store_path):
+                os.makedirs(os.path.dirname(store_path), exist_ok=True)
+                tmp_path = f'{store_path}.{os.getpid()}.{id(dst_path)}.tmp'
+                shutil.copyfile(src_path, tmp_path)
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, store_path)
+            os.link(store_path, dst_path)
+            return True
+        except OSError:
+            # e.g. the store is on another filesystem
+            self.hardlink = False
+            return False
+
+    def save(self):
+        if self.hashes_path is not None:
+            import json
+
+            live_hashes = {
+                memo_key: h
+                for memo_key, h in self.hashes.items()
+                if os.path.exists(memo_key.rsplit(':', 3)[0])
+            }
+            os.makedirs(os.path.dirname(self.hashes_path), exist_ok=True)
+            write_file(self.hashes_path, json.dumps(live_hashes))
+
+    @staticmethod
+    def prune(store_dirpath):
+        """Removes store files that no build links to anymore. Returns the number removed."""
+        pruned_count = 0
+        for store_subdirpath, _, store_filenames in os.walk(store_dirpath):
+            for store_filename in store_filenames:
+                store_path = os.path.join(store_subdirpath, store_filename)
+                if os.stat(store_path).st_nlink <= 1:
+                    os.remove(store_path)
+                    pruned_count += 1
+        return pruned_count
+
+
+# the text outputs that nginx serves with `brotli_static on; gzip_static on;`
+PRECOMPRESS_EXTENSIONS = [
+    '.html',
+    '.css',
+    '.js',
+    '.mjs',
+    '.svg',
+    '.json',
+    '.txt',
+    '.xml',
+    '.webmanifest',
+]
+# below this, compression headers cost more than they save
+PRECOMPRESS_MIN_BYTES = 1024
+# a sibling must be at least this much smaller to be worth an extra file and lookup
+PRECOMPRESS_MIN_SAVINGS = 0.05
+BROTLI_QUALITY = 11
+GZIP_LEVEL = 9
+
+
+def compress(encoding, content):
+    if encoding == 'br':
+        import brotli
+
+        return brotli.compress(content, quality=BROTLI_QUALITY)
+    else:
+        import gzip
+
+        # a fixed mtime keeps the output a pure function of the content
+        return gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compress_options():
+    """Encoding -> the options that `compress` depends on, for cache keys. Without brotli, only `gz`."""
+    options = {'gz': [GZIP_LEVEL]}
+    try:
+        import brotli
+        options['br'] = [BROTLI_QUALITY, brotli.__version__]
+    except ImportError:
+        pass
+    return options
+
+
+def process_pool(jobs):
+    """A process pool whose workers are not forked from this process.
+    Other threads may be starting a tool at the time, and a forked worker that never execs
+    would hold the tool's exec status pipe open, so the tool's `subprocess.run` would never return."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context(method))
+
+
+def precompress(build_dirpath, executor, log, cache=None):
+    """Writes `.br` and `.gz` siblings next to every text output in `build_dirpath`, and its summary to `log`.
+
+    Compression runs on the process pool `executor` since brotli at quality 11 is cpu bound.
+    """
+    options = compress_options()
+    if 'br' not in options:
+        log.write('brotli is not installed (pip install brotli), writing .gz only\n')
+    encodings = [encoding for encoding in ['br', 'gz'] if encoding in options]
+
+    paths = []
+    for process_dirpath, process_dirnames, process_filenames in os.walk(build_dirpath):
+        process_dirnames.sort()
+        for process_filename in sorted(process_filenames):
+            if os.path.splitext(process_filename)[1] in PRECOMPRESS_EXTENSIONS:
+                path = os.path.join(process_dirpath, process_filename)
+                if PRECOMPRESS_MIN_BYTES <= os.path.getsize(path):
+                    paths.append(path)
+
+    # path -> encoding -> compressed content
+    outputs = {path: {} for path in paths}
+    contents = {}
+    keys = {}
+    pending = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            content = f.read()
+        contents[path] = content
+        for encoding in encodings:
+            if cache is not None:
+                keys[(path, encoding)] = Cache.key('precompress', encoding, options[encoding], Cache.hash(content))
+                output = cache.get(keys[(path, encoding)], binary=True)
+                if output is not None:
+                    outputs[path][encoding] = output
+                    continue
+            pending.append((path, encoding))
+
+    if pending:
+        compressed = executor.map(
+            compress,
+            [encoding for _, encoding in pending],
+            [contents[path] for path, _ in pending]
+        )
+        for (path, encoding), output in zip(pending, compressed):
+            outputs[path][encoding] = output
+            if cache is not None:
+                cache.put(keys[(path, encoding)], output)
+
+    total_sizes = {encoding: 0 for encoding in [None] + encodings}
+    for path in paths:
+        size = len(contents[path])
+        total_sizes[None] += size
+        for encoding in encodings:
+            output = outputs[path][encoding]
+            # only ship siblings that actually help
+            if len(output) <= size * (1 - PRECOMPRESS_MIN_SAVINGS):
+                write_file(f'{path}.{encoding}', output)
+                total_sizes[encoding] += len(output)
+            else:
+                total_sizes[encoding] += size
+
+    def mb(size):
+        return f'{size / 1e6:.1f} MB'
+
+    summary = ' -> '.join(f'{mb(total_sizes[encoding])} {encoding or "raw"}' for encoding in [None] + encodings)
+    log.write(f'Precompressed {len(paths)} files ({len(pending)} compressed, {len(paths) * len(encodings) - len(pending)} cached): {summary}\n')
+
+
+# the `@font-face` sources that `--subset-fonts` can subset
+SUBSET_FONT_EXTENSIONS = [
+    '.woff2',
+    '.woff',
+    '.ttf',
+    '.otf',
+]
+
+
+def parse_unicode_range(text):
+    """The code points of a css `unicode-range`, e.g. `U+0000-00FF, U+0131, U+4??`."""
+    codepoints = set()
+    for part in text.split(','):
+        part = part.strip().upper()
+        if not part.startswith('U+'):
+            continue
+        part = part[2:]
+        if '-' in part:
+            start, end = part.split('-', 1)
+        else:
+            start, end = part.replace('?', '0'), part.replace('?', 'F')
+        codepoints.update(range(int(start, 16), int(end, 16) + 1))
+    return codepoints
+
+
+def unicode_range(codepoints):
+    """The shortest css `unicode-range` of `codepoints`."""
+    ranges = []
+    for codepoint in sorted(codepoints):
+        if ranges and ranges[-1][1] + 1 == codepoint:
+            ranges[-1][1] = codepoint
+        else:
+            ranges.append([codepoint, codepoint])
+    return ', '.join(
+        f'U+{start:X}' if start == end else f'U+{start:X}-{end:X}'
+        for start, end in ranges
+    )
+
+
+def subset_font(content, codepoints, ligatures):
+    """A woff2 of the font `content` with just the glyphs for `codepoints`, or `b''` when it cannot be subset.
+    For icon fonts drawn by ligature, `ligatures` are the words whose ligature glyphs to keep,
+    and no other ligatures are kept."""
+    import io
+    from fontTools import subset
+    from fontTools.ttLib import TTFont
+
+    try:
+        # the source timestamp, so the same subset is written on every build
+        font = TTFont(io.BytesIO(content), recalcTimestamp=False)
+    except Exception:
+        return b''
+
+    glyphs = []
+    if ligatures and 'GSUB' in font:
+        cmap = font.getBestCmap()
+        words = {
+            tuple(cmap.get(ord(c)) for c in word)
+            for word in ligatures
+        }
+        for lookup in font['GSUB'].table.LookupList.Lookup:
+            for subtable in lookup.SubTable:
+                subtable = getattr(subtable, 'ExtSubTable', subtable)
+                for first, first_ligatures in getattr(subtable, 'ligatures', {}).items():
+                    for ligature in first_ligatures:
+                        if (first, *ligature.Component) in words:
+                            glyphs.append(ligature.LigGlyph)
+
+    options = subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    # the closure would pull in every ligature that can be spelled with the kept letters
+    options.layout_closure = not ligatures
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=codepoints, glyphs=glyphs)
+    subsetter.subset(font)
+
+    out = io.BytesIO()
+    font.flavor = 'woff2'
+    font.save(out)
+    return out.getvalue()
+
+
+# the images that `--images` recompresses and writes variants of
+IMAGE_EXTENSIONS = [
+    '.png',
+    '.jpg',
+    '.jpeg',
+]
+# variant widths in pixels, a variant at the image's own width is always written
+IMAGE_WIDTHS = [480, 960, 1920]
+# in `<source>` order, the browser takes the first format it supports
+IMAGE_FORMATS = ['avif', 'webp']
+IMAGE_QUALITY = {
+    'avif': 60,
+    'webp': 80,
+}
+
+
+def image_variant_path(path, width, image_format):
+    root, _ = os.path.splitext(path)
+    return f'{root}-{width}w.{image_format}'
+
+
+def image_size(content):
+    """(width, height) as displayed, i.e. after the exif orientation."""
+    import io
+    from PIL import Image
+
+    with Image.open(io.BytesIO(content)) as image:
+        width, height = image.size
+        orientation = image.getexif().get(0x0112, 1)
+    # orientations 5-8 swap the axes
+    if 5 <= orientation:
+        width, height = height, width
+    return width, height
+
+
+def optimize_image(content, ext):
+    """`content` losslessly recompressed, or `b''` when that does not make it smaller.
+    png is re-encoded by Pillow, jpeg is optimized by `jpegtran` when it is installed."""
+    import io
+
+    if ext == '.png':
+        from PIL import Image
+
+        # Pillow reads 16 bit channels as 8 bit, so those would not round trip
+        if len(content) < 25 or content[24] == 16:
+            return b''
+        with Image.open(io.BytesIO(content)) as image:
+            if getattr(image, 'is_animated', False):
+                return b''
+            out = io.BytesIO()
+            image.save(out, format='PNG', optimize=True)
+        output = out.getvalue()
+    else:
+        import subprocess
+
+        try:
+            p = subprocess.run(
+                ['jpegtran', '-copy', 'all', '-optimize', '-progressive'],
+                input=content,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+        except FileNotFoundError:
+            return b''
+        if p.returncode != 0:
+            return b''
+        output = p.stdout
+
+    if len(content) <= len(output):
+        return b''
+    return output
+
+
+def image_variant(content, width, image_format):
+    """`content` scaled to `width` and encoded as `image_format`."""
+    import io
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(content)) as image:
+        image = ImageOps.exif_transpose(image)
+        if 'A' in image.getbands() or 'transparency' in image.info:
+            image = image.convert('RGBA')
+        else:
+            image = image.convert('RGB')
+        if image.width != width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format=image_format.upper(), quality=IMAGE_QUALITY[image_format])
+    return out.getvalue()
+
+
+# written next to the build dir, `build.<timestamp>/webgen-manifest.json`
+MANIFEST_FILENAME = 'webgen-manifest.json'
+
+
+def hash_file(path):
+    import hashlib
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_manifest(dirpath, previous=None):
+    """Returns {relative path: {'size', 'mtime', 'sha256'}} for every file under `dirpath`.
+    Entries of a `previous` manifest are reused when the size and mtime still match."""
+    previous = previous or {}
+    files = {}
+    for file_dirpath, file_dirnames, file_filenames in os.walk(dirpath, followlinks=True):
+        for file_filename in file_filenames:
+            path = os.path.join(file_dirpath, file_filename)
+            relpath = os.path.relpath(path, dirpath)
+            stat = os.stat(path)
+            file = previous.get(relpath)
+            if not file or file.get('size') != stat.st_size or file.get('mtime') != stat.st_mtime_ns:
+                file = {
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime_ns,
+                    'sha256': hash_file(path),
+                }
+            files[relpath] = file
+    return files
+
+
+def load_manifest(dirpath):
+    """The files of the current build of the webgen site at `dirpath`,
+    or of the plain directory `dirpath`, e.g. another tool's output.
+    Files added or changed after the build, e.g. by the Makefile, are hashed again."""
+    import json
+
+    build_linkpath = os.path.join(dirpath, 'build')
+    if os.path.isdir(build_linkpath):
+        manifest_path = os.path.join(os.path.dirname(os.path.realpath(build_linkpath)), MANIFEST_FILENAME)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as f:
+                return file_manifest(build_linkpath, previous=json.load(f)['files'])
+    if os.path.isdir(dirpath):
+        return file_manifest(dirpath)
+    return {}
+
+
+# extension -> (`as`, `type`) of a `<link rel=preload>`
+PRELOAD_TYPES = {
+    '.css': ('style', None),
+    '.js': ('script', None),
+    '.woff2': ('font', 'font/woff2'),
+    '.woff': ('font', 'font/woff'),
+    '.ttf': ('font', 'font/ttf'),
+    '.otf': ('font', 'font/otf'),
+    '.png': ('image', 'image/png'),
+    '.jpg': ('image', 'image/jpeg'),
+    '.jpeg': ('image', 'image/jpeg'),
+    '.svg': ('image', 'image/svg+xml'),
+    '.webp': ('image', 'image/webp'),
+    '.avif': ('image', 'image/avif'),
+}
+
+
+def head_preloads(page_html):
+    """The same-origin stylesheets, blocking and deferred scripts and `<link rel=preload>`s in the `<head>` of `page_html`,
+    in order, as [{'href', 'as', and 'type' and 'crossorigin' when set}]."""
+    from html.parser import HTMLParser
+
+    preloads = []
+
+    class HeadParser(HTMLParser):
+        done = False
+
+        def handle_starttag(self, tag, attrs):
+            if self.done:
+                return
+            if tag == 'body':
+                self.done = True
+                return
+            attrs = dict(attrs)
+            if tag == 'link' and attrs.get('rel') == 'stylesheet':
+                preload = {'href': attrs.get('href'), 'as': 'style'}
+            elif tag == 'link' and attrs.get('rel') == 'preload':
+                preload = {
+                    name: value
+                    for name, value in attrs.items()
+                    if name in ['href', 'as', 'type', 'crossorigin']
+                }
+            elif tag == 'script' and 'async' not in attrs:
+                preload = {'href': attrs.get('src'), 'as': 'script'}
+            else:
+                return
+            href = preload.get('href')
+            # another origin's resource would need its own connection first
+            if href and href.startswith('/') and not href.startswith('//') and 'as' in preload:
+                if href not in [p['href'] for p in preloads]:
+                    preloads.append(preload)
+
+        def handle_endtag(self, tag):
+            if tag == 'head':
+                self.done = True
+
+    parser = HeadParser()
+    parser.feed(page_html)
+    parser.close()
+    return preloads
+
+
+def link_header(preloads):
+    """The `Link` header value that preloads `preloads`, see `head_preloads`.
+    CDNs can send it ahead of the response as 103 Early Hints."""
+    links = []
+    for preload in preloads:
+        link = f'<{preload["href"]}>; rel=preload; as={preload["as"]}'
+        if preload.get('type'):
+            link += f'; type="{preload["type"]}"'
+        if 'crossorigin' in preload:
+            link += '; crossorigin'
+        links.append(link)
+    return ', '.join(links)
+
+
+def load_preloads(dirpath):
+    """The `Link` header value of each page of the current build of the webgen site at `dirpath`,
+    keyed by the page's path in the build. Empty for a build without preloads or a plain directory."""
+    import json
+
+    build_linkpath = os.path.join(dirpath, 'build')
+    if os.path.isdir(build_linkpath):
+        manifest_path = os.path.join(os.path.dirname(os.path.realpath(build_linkpath)), MANIFEST_FILENAME)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as f:
+                preloads = json.load(f).get('preloads', {})
+            return {
+                path: link_header(page_preloads)
+                for path, page_preloads in preloads.items()
+                if page_preloads
+            }
+    return {}
+
+
+BUDGET_REPORT_FILENAME = 'webgen-budget.json'
+
+# gen `budgets` limits, see `page_weight`
+BUDGET_LIMITS = ['raw', 'gzip', 'br', 'inlined', 'requests', 'asset']
+
+# largest assets listed per page in the budget report
+BUDGET_LARGEST_COUNT = 5
+
+
+def page_loads(page_html, page_path, files):
+    """`(paths, inlined)`: the build paths of the page `page_path` and the same-origin files it loads,
+    with the build manifest `files`, and the bytes of its `<style>` and `<script>` content.
+    Each `<picture>` counts its first source's widest image, as does an `<img>` with a `srcset`."""
+    import json
+    import re
+    from html.parser import HTMLParser
+
+    urls = []
+    inlined = [0]
+
+    def widest(srcset):
+        candidates = []
+        for candidate in srcset.split(','):
+            parts = candidate.split()
+            if parts:
+                width = parts[1] if len(parts) > 1 else '0w'
+                candidates.append((int(width[:-1]) if width[:-1].isdigit() else 0, parts[0]))
+        return max(candidates)[1] if candidates else None
+
+    class PageParser(HTMLParser):
+        picture_url = None
+        in_picture = False
+        inline_tag = None
+
+        def handle_starttag(self, tag, attrs):
+            attrs = dict(attrs)
+            if tag == 'picture':
+                self.in_picture = True
+                self.picture_url = None
+            elif tag == 'source' and self.in_picture:
+                if self.picture_url is None and attrs.get('srcset'):
+                    self.picture_url = widest(attrs['srcset'])
+            elif tag == 'img':
+                url = self.picture_url if self.in_picture else None
+                url = url or (widest(attrs['srcset']) if attrs.get('srcset') else attrs.get('src'))
+                urls.append(url)
+            elif tag == 'link' and attrs.get('rel') in ['stylesheet', 'preload', 'icon'] and attrs.get('href'):
+                urls.append(attrs['href'])
+            elif tag == 'script' and attrs.get('src'):
+                urls.append(attrs['src'])
+            elif tag in ['style', 'script']:
+                self.inline_tag = tag
+
+        def handle_endtag(self, tag):
+            if tag == 'picture':
+                self.in_picture = False
+            elif tag == self.inline_tag:
+                self.inline_tag = None
+
+        def handle_data(self, data):
+            if self.inline_tag is not None:
+                inlined[0] += len(data.encode('utf-8'))
+                # the urls of `idle` bundles
+                for m in re.finditer(r'webgenLoad\((\[[^\]]*\])', data):
+                    urls.extend(json.loads(m.group(1)))
+
+    parser = PageParser()
+    parser.feed(page_html)
+    parser.close()
+
+    paths = [page_path]
+    for url in urls:
+        if not url or ':' in url.split('/')[0] or url.startswith('//'):
+            continue
+        url_path = re.match(r'[^?#]*', url).group(0)
+        if url_path.startswith('/'):
+            path = url_path[1:]
+        else:
+            path = os.path.normpath(os.path.join(os.path.dirname(page_path), url_path))
+        if path in files and path not in paths:
+            paths.append(path)
+    return paths, inlined[0]
+
+
+def compressed_sizes(build_dirpath, paths, files, executor, cache=None):
+    """{path: {content coding: size}} of the `paths` of the build at `build_dirpath`, with the build manifest `files`,
+    that `precompress` would write a sibling for but that have none, e.g. in a build without `--precompress`.
+    Compression runs on the process pool `executor` and shares the cache entries of `precompress`."""
+    options = compress_options()
+    # (path, encoding)
+    pending = []
+    for path in paths:
+        file = files[path]
+        if os.path.splitext(path)[1] not in PRECOMPRESS_EXTENSIONS or file['size'] < PRECOMPRESS_MIN_BYTES:
+            continue
+        for encoding in options:
+            if CONTENT_CODINGS[f'.{encoding}'] not in file.get('encodings', {}):
+                pending.append((path, encoding))
+
+    contents = {}
+    for path in sorted(set(path for path, _ in pending)):
+        with open(os.path.join(build_dirpath, path), 'rb') as f:
+            contents[path] = f.read()
+
+    outputs = {}
+    keys = {}
+    missing = []
+    for path, encoding in pending:
+        if cache is not None:
+            keys[(path, encoding)] = Cache.key('precompress', encoding, options[encoding], Cache.hash(contents[path]))
+            output = cache.get(keys[(path, encoding)], binary=True)
+            if output is not None:
+                outputs[(path, encoding)] = output
+                continue
+        missing.append((path, encoding))
+    if missing:
+        compressed = executor.map(
+            compress,
+            [encoding for _, encoding in missing],
+            [contents[path] for path, _ in missing]
+        )
+        for (path, encoding), output in zip(missing, compressed):
+            outputs[(path, encoding)] = output
+            if cache is not None:
+                cache.put(keys[(path, encoding)], output)
+
+    sizes = {}
+    for (path, encoding), output in outputs.items():
+        # like `precompress`, which only writes siblings that help
+        if len(output) <= files[path]['size'] * (1 - PRECOMPRESS_MIN_SAVINGS):
+            sizes.setdefault(path, {})[CONTENT_CODINGS[f'.{encoding}']] = len(output)
+    return sizes
+
+
+def page_weight(page_html, page_path, files, compressed=None):
+    """What loading the page `page_path` of the build transfers, with the build manifest `files`:
+    `raw`, `gzip` and `br` bytes of the page and the same-origin files it loads, `inlined` bytes of
+    `<style>` and `<script>` content, the number of `requests`, the largest `asset` and the `largest` files.
+    The `compressed_sizes` of files without precompressed siblings are `compressed`, else they count as raw."""
+    compressed = compressed or {}
+    paths, inlined = page_loads(page_html, page_path, files)
+
+    def size(path, coding=None):
+        file = files[path]
+        encodings = dict(compressed.get(path, {}), **file.get('encodings', {}))
+        if coding == 'br':
+            return encodings.get('br', encodings.get('gzip', file['size']))
+        if coding == 'gzip':
+            return encodings.get('gzip', file['size'])
+        return file['size']
+
+    largest = sorted(paths[1:], key=lambda path: (-size(path), path))[:BUDGET_LARGEST_COUNT]
+    return {
+        'raw': sum(size(path) for path in paths),
+        'gzip': sum(size(path, 'gzip') for path in paths),
+        'br': sum(size(path, 'br') for path in paths),
+        'inlined': inlined,
+        'requests': len(paths),
+        'asset': size(largest[0]) if largest else 0,
+        'largest': [[path, size(path)] for path in largest],
+    }
+
+
+def over_budget(report, budgets):
+    """The limits of the gen `budgets`, page glob -> {limit: max}, that pages of the budget `report` exceed,
+    as [(page path, limit, value, max)]."""
+    import fnmatch
+
+    exceeded = []
+    for page_path, weight in sorted(report.items()):
+        for pattern, limits in budgets.items():
+            if not fnmatch.fnmatch(page_path, pattern):
+                continue
+            for limit, max_value in limits.items():
+                if max_value < weight[limit]:
+                    exceeded.append((page_path, limit, weight[limit], max_value))
+    return exceeded
+
+
+DELTA_FILENAME = 'webgen-delta.json'
+
+# precompressed sibling suffix -> http content coding
+CONTENT_CODINGS = {
+    '.br': 'br',
+    '.gz': 'gzip',
+}
+
+
+def add_encodings(files):
+    """Adds to each entry of the manifest `files` the `encodings` of its precompressed siblings,
+    content coding -> size."""
+    for relpath, file in files.items():
+        encodings = {
+            coding: files[f'{relpath}{suffix}']['size']
+            for suffix, coding in CONTENT_CODINGS.items()
+            if f'{relpath}{suffix}' in files
+        }
+        if encodings:
+            file['encodings'] = encodings
+    return files
+
+
+def manifest_delta(files, previous_files):
+    """The sorted `added`, `changed` and `removed` paths of the manifest `files` against `previous_files`,
+    and the `bytes` of the added and changed files."""
+    added = sorted(set(files) - set(previous_files))
+    changed = sorted(
+        relpath
+        for relpath in set(files) & set(previous_files)
+        if files[relpath]['sha256'] != previous_files[relpath]['sha256']
+    )
+    return {
+        'added': added,
+        'changed': changed,
+        'removed': sorted(set(previous_files) - set(files)),
+        'bytes': sum(files[relpath]['size'] for relpath in added + changed),
+    }
+
+
+def delta(dirpath, from_build=None, out=None):
+    """Prints what changed in the linked build of the site at `dirpath` against the build linked before it,
+    or against the build `from_build`. With `out`, writes a tar of the delta, then the added and changed files,
+    to the path `out`, or to stdout with `-`. A path ending in `.zst` is compressed with zstandard.
+
+    Both builds are scanned as they are now, since the deploy can change a build after webgen wrote its manifest,
+    e.g. the Makefile adds api.html and removes altstore/. Hashes of the manifests are reused for unchanged files."""
+    import io
+    import json
+    import tarfile
+
+    def read_json(path):
+        if not os.path.isfile(path):
+            print(f'Error: "{path}" does not exist\n', file=sys.stderr)
+            sys.exit(1)
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    build_root_dirname = linked_build(dirpath)
+    if build_root_dirname is None:
+        print(f'Error: "{dirpath}" has no build\n', file=sys.stderr)
+        sys.exit(1)
+    build_root_dirpath = os.path.join(dirpath, build_root_dirname)
+    if from_build is None:
+        from_build = read_json(os.path.join(build_root_dirpath, DELTA_FILENAME))['previous']
+
+    def current_files(build_dirname):
+        manifest = read_json(os.path.join(dirpath, build_dirname, MANIFEST_FILENAME))
+        return add_encodings(file_manifest(os.path.join(dirpath, build_dirname, 'build'), previous=manifest['files']))
+
+    build_delta = manifest_delta(
+        current_files(build_root_dirname),
+        current_files(from_build) if from_build is not None else {}
+    )
+    build_delta['previous'] = from_build
+
+    # the summary goes to stderr when the tar goes to stdout
+    report = sys.stderr if out == '-' else sys.stdout
+    report.write(
+        f'{build_root_dirname} against {build_delta["previous"]}: {len(build_delta["added"])} added, '
+        f'{len(build_delta["changed"])} changed, {len(build_delta["removed"])} removed, {build_delta["bytes"]} bytes\n'
+    )
+    if out is None:
+        return
+
+    if out == '-':
+        stream = sys.stdout.buffer
+    elif out.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            print('Error: zstandard is not installed (pip install zstandard)\n', file=sys.stderr)
+            sys.exit(1)
+        stream = zstandard.ZstdCompressor().stream_writer(open(out, 'wb'))
+    else:
+        stream = open(out, 'wb')
+
+    def add(tar, relpath, fileobj, size):
+        # fixed metadata, so the same files give the same archive
+        info = tarfile.TarInfo(relpath)
+        info.size = size
+        info.mode = 0o644
+        tar.addfile(info, fileobj)
+
+    try:
+        # a stream, so nothing is buffered and stdout can be piped, e.g. into `docker cp` or an upload
+        with tarfile.open(fileobj=stream, mode='w|') as tar:
+            delta_json = json.dumps(build_delta, indent=4, sort_keys=True).encode('utf-8')
+            add(tar, DELTA_FILENAME, io.BytesIO(delta_json), len(delta_json))
+            for relpath in build_delta['added'] + build_delta['changed']:
+                path = os.path.join(build_root_dirpath, 'build', relpath)
+                with open(path, 'rb') as f:
+                    add(tar, relpath, f, os.fstat(f.fileno()).st_size)
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+    if out != '-':
+        sys.stdout.write(f'Wrote "{out}"\n')
+
+
+PACK_FILENAME = 'webgen-site.pack'
+
+# magic, index offset, index length, entry count, content type count
+PACK_HEADER = '<8sQQII'
+PACK_MAGIC = b'WEBGEN\x00\x02'
+# path offset and length in the path region, content type, then the etag, offset and size of the identity, gzip and br content.
+# each variant has its own etag, since the bytes differ
+PACK_ENTRY = '<IHH16sQQ16sQQ16sQQ'
+# the variants of each entry, in `PACK_ENTRY` order
+PACK_ENCODINGS = ['identity', 'gzip', 'br']
+
+
+def pack_site(build_dirpath, files, out_path):
+    """Writes the build at `build_dirpath`, with the build manifest `files`, into one file at `out_path` for `PackedSite`.
+
+    After the `PACK_HEADER` comes the blob region, where each distinct content is stored once,
+    then the index: one `PACK_ENTRY` per path, sorted by path, the content types and the paths.
+    Precompressed siblings are variants of their file's entry rather than entries of their own.
+    A blob offset of 0 means the variant is missing, since blobs start after the header."""
+    import mimetypes
+    import shutil
+    import struct
+
+    coding_suffixes = {coding: suffix for suffix, coding in CONTENT_CODINGS.items()}
+    relpaths = sorted(
+        (relpath for relpath in files if not any(
+            relpath.endswith(suffix) and relpath[:-len(suffix)] in files
+            for suffix in CONTENT_CODINGS
+        )),
+        key=lambda relpath: relpath.encode('utf-8')
+    )
+
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b'\0' * struct.calcsize(PACK_HEADER))
+            # sha256 -> (offset, size)
+            blobs = {}
+
+            def blob(relpath):
+                file = files[relpath]
+                if file['sha256'] not in blobs:
+                    offset = f.tell()
+                    with open(os.path.join(build_dirpath, relpath), 'rb') as src:
+                        shutil.copyfileobj(src, f)
+                    blobs[file['sha256']] = (offset, f.tell() - offset)
+                return blobs[file['sha256']]
+
+            content_types = []
+            entries = []
+            paths = b''
+            for relpath in relpaths:
+                content_type = mimetypes.guess_type(relpath)[0] or 'application/octet-stream'
+                if content_type.startswith('text/') or content_type in ['application/javascript', 'application/json', 'image/svg+xml']:
+                    content_type += '; charset=utf-8'
+                if content_type not in content_types:
+                    content_types.append(content_type)
+                variants = []
+                for encoding in PACK_ENCODINGS:
+                    variant_relpath = relpath + coding_suffixes.get(encoding, '')
+                    if variant_relpath in files:
+                        variants.extend((bytes.fromhex(files[variant_relpath]['sha256'][:32]), *blob(variant_relpath)))
+                    else:
+                        variants.extend((b'', 0, 0))
+                path = relpath.encode('utf-8')
+                entries.append(struct.pack(
+                    PACK_ENTRY,
+                    len(paths),
+                    len(path),
+                    content_types.index(content_type),
+                    *variants
+                ))
+                paths += path
+
+            index_offset = f.tell()
+            f.write(b''.join(entries))
+            for content_type in content_types:
+                content_type = content_type.encode('utf-8')
+                f.write(struct.pack('<H', len(content_type)) + content_type)
+            f.write(paths)
+            index_length = f.tell() - index_offset
+
+            f.seek(0)
+            f.write(struct.pack(PACK_HEADER, PACK_MAGIC, index_offset, index_length, len(entries), len(content_types)))
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(relpaths), len(blobs)
+
+
+class PackedSite:
+    """Serves files from a `pack_site` file through an mmap.
+    A lookup is a binary search of the in-memory index, and the content is a zero-copy `memoryview` of the map.
+
+    e.g. `site.get('index.html', ['br', 'gzip'])` -> `(content, content type, etag, content coding)`.
+    """
+
+    def __init__(self, path):
+        import mmap
+        import struct
+
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, self.index_offset, index_length, self.count, content_type_count = struct.unpack_from(PACK_HEADER, self.map)
+        if magic != PACK_MAGIC:
+            self.close()
+            raise ValueError(f'"{path}" is not a webgen site pack')
+        self.entry_size = struct.calcsize(PACK_ENTRY)
+        offset = self.index_offset + self.count * self.entry_size
+        self.content_types = []
+        for _ in range(content_type_count):
+            (length,) = struct.unpack_from('<H', self.map, offset)
+            self.content_types.append(bytes(self.map[offset + 2:offset + 2 + length]).decode('utf-8'))
+            offset += 2 + length
+        self.paths_offset = offset
+
+    def _entry(self, i):
+        import struct
+
+        return struct.unpack_from(PACK_ENTRY, self.map, self.index_offset + i * self.entry_size)
+
+    def _path(self, entry):
+        start = self.paths_offset + entry[0]
+        return self.map[start:start + entry[1]]
+
+    def find(self, path):
+        """The index entry of `path`, relative to the build root, or `None`."""
+        key = path.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            entry_path = self._path(entry)
+            if entry_path == key:
+                return entry
+            if entry_path < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def get(self, path, accept_encodings=()):
+        """`(content, content type, etag, content coding)` of `path`, or `None`.
+        The content is the first variant of `accept_encodings`, e.g. `['br', 'gzip']`, that the pack has,
+        else the identity content, whose content coding is `None`. The etag is the content hash of that variant."""
+        entry = self.find(path)
+        if entry is None:
+            return None
+        variants = entry[3:]
+        for encoding in list(accept_encodings) + ['identity']:
+            if encoding not in PACK_ENCODINGS:
+                continue
+            i = PACK_ENCODINGS.index(encoding)
+            etag, offset, size = variants[3 * i:3 * i + 3]
+            if offset:
+                etag = etag.hex()
+                content = self.view[offset:offset + size]
+                return content, self.content_types[entry[2]], etag, None if encoding == 'identity' else encoding
+        return None
+
+    def resolve(self, url_path):
+        """The build path of `url_path` like nginx `try_files $uri $uri.html $uri/index.html`, or `None`."""
+        path = url_path.split('?', 1)[0].strip('/')
+        candidates = [path, f'{path}.html', f'{path}/index.html'] if path else ['index.html']
+        for candidate in candidates:
+            if self.find(candidate) is not None:
+                return candidate
+        return None
+
+    def close(self):
+        """Unmaps the pack. While a content view from `get` is still referenced the map cannot close,
+        it is then unmapped when the map and its views are garbage collected, so a server can swap packs under open responses."""
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+
+
+LINKS_REPORT_FILENAME = 'webgen-links.json'
+
+# bumped when `file_refs` changes, so cached refs of older versions are not used
+LINKS_VERSION = 1
+
+# build files that are fetched by well-known name rather than by reference, never orphans
+LINK_ROOTS = [
+    '*.html',
+    '*.txt',
+    '*.xml',
+    'manifest.json',
+    'favicon*',
+    'apple-touch-icon*',
+    '.well-known/*',
+]
+
+# listed per kind in the build output, the report has all of them
+LINKS_SHOWN_COUNT = 10
+
+
+def file_refs(content, ext):
+    """The urls that the html or css `content` refers to, as [url],
+    and for html the fragment ids it defines, as {'refs', 'ids'}."""
+    import json
+    import re
+    from html.parser import HTMLParser
+
+    css_url_re = re.compile(r"""url\(\s*(['"]?)([^'")]*)\1\s*\)|@import\s+(['"])([^'"]*)\3""")
+
+    def css_refs(css):
+        return [m.group(2) or m.group(4) for m in css_url_re.finditer(css)]
+
+    if ext == '.css':
+        return {'refs': css_refs(content), 'ids': []}
+
+    refs = []
+    ids = []
+
+    def srcset_refs(srcset):
+        return [candidate.split()[0] for candidate in srcset.split(',') if candidate.split()]
+
+    class RefParser(HTMLParser):
+        inline_tag = None
+
+        def handle_starttag(self, tag, attrs):
+            attrs = dict(attrs)
+            if attrs.get('id'):
+                ids.append(attrs['id'])
+            if tag == 'a' and attrs.get('name'):
+                ids.append(attrs['name'])
+            # another origin's urls, e.g. `<link rel=canonical>`, are skipped with the other absolute urls
+            for name in ['href', 'src', 'poster', 'data']:
+                if attrs.get(name):
+                    refs.append(attrs[name])
+            for name in ['srcset', 'imagesrcset']:
+                if attrs.get(name):
+                    refs.extend(srcset_refs(attrs[name]))
+            if attrs.get('style'):
+                refs.extend(css_refs(attrs['style']))
+            if tag in ['style', 'script'] and 'src' not in attrs:
+                self.inline_tag = tag
+
+        def handle_endtag(self, tag):
+            if tag == self.inline_tag:
+                self.inline_tag = None
+
+        def handle_data(self, data):
+            if self.inline_tag == 'style':
+                refs.extend(css_refs(data))
+            elif self.inline_tag == 'script':
+                # the urls of `idle` bundles
+                for m in re.finditer(r'webgenLoad\((\[[^\]]*\])', data):
+                    refs.extend(json.loads(m.group(1)))
+
+    parser = RefParser()
+    parser.feed(content)
+    parser.close()
+    return {'refs': refs, 'ids': ids}
+
+
+def read_file_refs(path):
+    """`file_refs` of the file at `path`, for a process pool."""
+    with open(path, 'r', errors='replace') as f:
+        return file_refs(f.read(), os.path.splitext(path)[1].lower())
+
+
+def link_report(build_dirpath, files, executor, log, fingerprints=None, cache=None):
+    """Parses every html and css file of the build at `build_dirpath`, with the build manifest `files`, once,
+    then resolves every reference like nginx `try_files $uri $uri.html $uri/index.html` against the build.
+    Returns {'dangling': [{'file', 'ref'}], 'orphans': [path]}: references to missing files or fragments,
+    and files that nothing refers to, which may not need to be in the build.
+    Files only referred to from scripts show up as orphans.
+
+    Parsing runs on the process pool `executor`, and the refs of each file are cached by its content hash.
+    Writes a summary to `log`."""
+    import fnmatch
+    import json
+    from urllib.parse import unquote
+
+    fingerprints = fingerprints or {}
+    relpaths = sorted(
+        relpath
+        for relpath in files
+        if os.path.splitext(relpath)[1].lower() in ['.html', '.css']
+    )
+
+    # relpath -> `file_refs`
+    refs = {}
+    keys = {}
+    pending = []
+    for relpath in relpaths:
+        if cache is not None:
+            keys[relpath] = Cache.key('links', LINKS_VERSION, files[relpath]['sha256'], os.path.splitext(relpath)[1].lower())
+            output = cache.get(keys[relpath])
+            if output is not None:
+                refs[relpath] = json.loads(output)
+                continue
+        pending.append(relpath)
+
+    if pending:
+        outputs = executor.map(read_file_refs, [os.path.join(build_dirpath, relpath) for relpath in pending])
+        for relpath, output in zip(pending, outputs):
+            refs[relpath] = output
+            if cache is not None:
+                cache.put(keys[relpath], json.dumps(output))
+
+    def resolve(url_path):
+        if url_path.endswith('/') or not url_path:
+            candidates = [os.path.join(url_path, 'index.html')]
+        else:
+            candidates = [url_path, f'{url_path}.html', os.path.join(url_path, 'index.html')]
+        for candidate in candidates:
+            if candidate in files:
+                return candidate
+        return None
+
+    dangling = []
+    referenced = set()
+    for relpath in relpaths:
+        for ref in refs[relpath]['refs']:
+            ref = ref.strip()
+            if not ref or ':' in ref.split('/')[0].split('#')[0] or ref.startswith('//'):
+                continue
+            ref_path, _, fragment = ref.partition('#')
+            url_path = unquote(ref_path.split('?', 1)[0])
+            if not url_path:
+                # a fragment of the same file
+                target = relpath
+            else:
+                if url_path.startswith('/'):
+                    path = url_path[1:]
+                else:
+                    path = os.path.normpath(os.path.join(os.path.dirname(relpath), url_path))
+                    if path == '.':
+                        path = ''
+                if url_path.endswith('/') and path:
+                    path += '/'
+                target = resolve(path)
+                if target is None:
+                    dangling.append({'file': relpath, 'ref': ref})
+                    continue
+                referenced.add(target)
+            if fragment and target.endswith('.html') and fragment not in refs[target]['ids']:
+                dangling.append({'file': relpath, 'ref': ref})
+
+    # a fingerprinted copy and its original are one asset
+    for path, fingerprinted_path in fingerprints.items():
+        if path in referenced or fingerprinted_path in referenced:
+            referenced.update([path, fingerprinted_path])
+
+    orphans = []
+    for relpath in sorted(files):
+        if relpath in referenced or any(fnmatch.fnmatch(relpath, pattern) for pattern in LINK_ROOTS):
+            continue
+        # a precompressed sibling goes with its file
+        if any(relpath.endswith(suffix) and relpath[:-len(suffix)] in files for suffix in CONTENT_CODINGS):
+            continue
+        orphans.append(relpath)
+
+    log.write(f'Checked links of {len(relpaths)} files ({len(pending)} parsed, {len(relpaths) - len(pending)} cached)\n')
+    return {
+        'dangling': dangling,
+        'orphans': orphans,
+    }
+
+
+# assets that are safe to serve under a content-hashed name with `Cache-Control: immutable`
+FINGERPRINT_EXTENSIONS = [
+    '.css',
+    '.js',
+    '.woff2',
+    '.woff',
+    '.ttf',
+    '.otf',
+    '.png',
+    '.jpg',
+    '.jpeg',
+    '.gif',
+    '.webp',
+    '.avif',
+    '.svg',
+    '.ico',
+]
+FINGERPRINT_HASH_LENGTH = 12
+
+
+def fingerprint_path(path, h):
+    root, ext = os.path.splitext(path)
+    return f'{root}.{h[:FINGERPRINT_HASH_LENGTH]}{ext}'
+
+
+def rewrite_css_urls(css, css_path, rewrite):
+    """Replaces each `url(...)` in `css` with `rewrite(path)` when that returns a path.
+    `path` is relative to the build root and `css_path` is the stylesheet's build path.
+    A `rewrite` result that starts with `/` is used as the url as is."""
+    import re
+
+    def replace_url(m):
+        quote, url = m.group(1), m.group(2).strip()
+        if ':' in url.split('/')[0] or url.startswith('//') or url.startswith('#'):
+            return m.group(0)
+        url_path, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+        if url_path.startswith('/'):
+            path = url_path[1:]
+        else:
+            path = os.path.normpath(os.path.join(os.path.dirname(css_path), url_path))
+        rewritten_path = rewrite(path)
+        if rewritten_path is None:
+            return m.group(0)
+        if rewritten_path.startswith('/'):
+            rewritten_url = rewritten_path
+        else:
+            # keep the url relative if it was, the rewritten file is in the same directory
+            rewritten_url = os.path.join(os.path.dirname(url_path), os.path.basename(rewritten_path))
+        return f'url({quote}{rewritten_url}{suffix}{quote})'
+
+    return re.sub(r"""url\(\s*(['"]?)([^'")]*)\1\s*\)""", replace_url, css)
+
+
+# at-rules whose block holds rules rather than declarations
+CSS_NESTED_AT_RULES = [
+    '@media',
+    '@supports',
+    '@layer',
+    '@container',
+    '@document',
+    '@-moz-document',
+]
+
+
+def parse_css(css):
+    """Splits a stylesheet into `(prelude, body)` rules, in order.
+    `body` is the declaration text, a list of rules for `CSS_NESTED_AT_RULES`,
+    or `None` for statements such as `@import`."""
+    import re
+
+    # strings are matched whole so braces and comment markers inside them do not count
+    token_re = re.compile(r""""(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|/\*.*?(?:\*/|$)|[{};]""", re.S)
+
+    def strip_comments(text):
+        return re.sub(r'/\*.*?(?:\*/|$)', '', text, flags=re.S).strip()
+
+    def block_end(i):
+        """The index of the `}` that closes the block opened just before `i`."""
+        depth = 1
+        for m in token_re.finditer(css, i):
+            if m.group(0) == '{':
+                depth += 1
+            elif m.group(0) == '}':
+                depth -= 1
+                if depth == 0:
+                    return m.start()
+        return len(css)
+
+    def parse(i):
+        rules = []
+        start = i
+        while True:
+            m = token_re.search(css, i)
+            if m is None:
+                return rules, len(css)
+            token = m.group(0)
+            i = m.end()
+            if token == '{':
+                prelude = strip_comments(css[start:m.start()])
+                at_rule = prelude.split(None, 1)[0].lower() if prelude else ''
+                if at_rule in CSS_NESTED_AT_RULES:
+                    body, i = parse(i)
+                else:
+                    end = block_end(i)
+                    body = css[i:end].strip()
+                    i = end + 1
+                rules.append((prelude, body))
+                start = i
+            elif token == ';':
+                prelude = strip_comments(css[start:m.start()])
+                if prelude:
+                    rules.append((prelude, None))
+                start = i
+            elif token == '}':
+                return rules, i
+
+    rules = []
+    i = 0
+    while i < len(css):
+        # a stray `}` at the top level ends `parse` early, so carry on after it
+        more_rules, i = parse(i)
+        rules.extend(more_rules)
+    return rules
+
+
+def serialize_css(rules):
+    parts = []
+    for prelude, body in rules:
+        if body is None:
+            parts.append(f'{prelude};')
+        elif isinstance(body, list):
+            parts.append(f'{prelude}{{{serialize_css(body)}}}')
+        else:
+            parts.append(f'{prelude}{{{body}}}')
+    return ''.join(parts)
+
+
+class CssUsage:
+    """The tag names, classes and ids that a set of content files can produce."""
+
+    def __init__(self):
+        self.tags = set()
+        self.classes = set()
+        self.ids = set()
+
+    def add_html(self, html):
+        """Adds the elements of `html`. Script and style text is ignored."""
+        from html.parser import HTMLParser
+
+        usage = self
+
+        class Parser(HTMLParser):
+            def handle_starttag(self, tag, attrs):
+                usage.tags.add(tag.lower())
+                for name, value in attrs:
+                    if name == 'class' and value:
+                        usage.classes.update(value.split())
+                    elif name == 'id' and value:
+                        usage.ids.add(value)
+
+        parser = Parser(convert_charrefs=True)
+        parser.feed(html)
+        parser.close()
+
+    def add_words(self, text):
+        """Adds every word of `text` as a possible tag, class and id,
+        e.g. for scripts that build class names at runtime."""
+        import re
+
+        words = set(re.findall(r'[A-Za-z0-9_-]+', text))
+        self.tags.update(word.lower() for word in words)
+        self.classes.update(words)
+        self.ids.update(words)
+
+    def selector_used(self, selector):
+        """Whether some element could match `selector`. Pseudo-classes and attribute
+        selectors are ignored, so the answer errs on the side of keeping a rule."""
+        import re
+
+        selector = re.sub(r'\[[^\]]*\]', '', selector)
+        # `:not(...)`, `:is(...)` and friends are dropped along with their arguments
+        selector = re.sub(r'::?[\w-]+(\((?:[^()]|\([^()]*\))*\))?', '', selector)
+        for prefix, name in re.findall(r'([.#]?)((?:\\.|[\w-])+)', selector):
+            name = re.sub(r'\\(.)', r'\1', name)
+            if prefix == '.':
+                if name not in self.classes:
+                    return False
+            elif prefix == '#':
+                if name not in self.ids:
+                    return False
+            elif name.lower() not in self.tags:
+                return False
+        return True
+
+
+def filter_css_selectors(rules, usage, keep_selector=None):
+    """The rules of `parse_css` with a selector that `usage` can match.
+    `keep_selector(selector)` can force a selector to be kept. At-rules other than
+    `CSS_NESTED_AT_RULES` are kept, see `filter_css_references`."""
+
+    def used(prelude):
+        return any(
+            usage.selector_used(selector) or (keep_selector is not None and keep_selector(selector.strip()))
+            for selector in prelude.split(',')
+        )
+
+    kept = []
+    for prelude, body in rules:
+        if prelude.startswith('@'):
+            if isinstance(body, list):
+                body = filter_css_selectors(body, usage, keep_selector=keep_selector)
+                if body:
+                    kept.append((prelude, body))
+            else:
+                kept.append((prelude, body))
+        elif used(prelude):
+            kept.append((prelude, body))
+    return kept
+
+
+def css_declarations(rules):
+    """The declaration text of the style rules, e.g. to find the fonts and animations they use."""
+    declarations = []
+    for prelude, body in rules:
+        if isinstance(body, list):
+            declarations.append(css_declarations(body))
+        elif body is not None and not prelude.startswith('@'):
+            declarations.append(body)
+    return '\n'.join(declarations)
+
+
+def filter_css_references(rules, declarations):
+    """Drops the `@font-face` and `@keyframes` rules that `declarations` do not refer to."""
+    import re
+
+    words = set(re.findall(r'[\w-]+', declarations))
+
+    def referenced(prelude, body):
+        at_rule = prelude.split(None, 1)[0].lower()
+        if at_rule == '@font-face':
+            m = re.search(r'font-family\s*:\s*([^;]+)', body or '')
+            return m is None or m.group(1).strip().strip('\'"') in declarations
+        if at_rule.endswith('keyframes'):
+            parts = prelude.split(None, 1)
+            return len(parts) < 2 or parts[1].strip().strip('\'"') in words
+        return True
+
+    filtered = []
+    for prelude, body in rules:
+        if isinstance(body, list):
+            body = filter_css_references(body, declarations)
+            if body:
+                filtered.append((prelude, body))
+        elif not prelude.startswith('@') or referenced(prelude, body):
+            filtered.append((prelude, body))
+    return filtered
+
+
+# marks the `inline_css()` placeholders in a rendered page
+CRITICAL_CSS_ATTR = 'data-webgen-critical-css'
+# inlined bytes per page, written next to the build dir
+CRITICAL_CSS_REPORT_FILENAME = 'webgen-critical-css.json'
+
+
+# how a gen `bundles` entry loads: `eager` blocks rendering, `defer` runs after parsing,
+# and `idle` loads after the page has loaded, when the browser is idle
+BUNDLE_LOADS = ['eager', 'defer', 'idle']
+
+# defines `webgenLoad(urls, delay)`, which adds the scripts and stylesheets `urls` in order
+# `delay` ms after the page has loaded, once the browser is idle. added once to each page with an `idle` bundle
+BUNDLE_LOADER_SCRIPT = (
+    "<script>window.webgenLoad=window.webgenLoad||function(urls,delay){"
+    "var load=function(){setTimeout(function(){(window.requestIdleCallback||setTimeout)(function(){urls.forEach(function(url){"
+    "var e;if(/\\.css([?#]|$)/.test(url)){e=document.createElement('link');e.rel='stylesheet';e.href=url}"
+    "else{e=document.createElement('script');e.src=url;e.async=false}document.head.appendChild(e)})})},delay||0)};"
+    "document.readyState=='complete'?load():addEventListener('load',load)}</script>"
+)
+
+
+class BuildFiles:
+    """Memoized reads of processed files in the build dir, shared by every render.
+
+    An entry is reused while the file's size and mtime are unchanged,
+    so a phase that rewrites a file invalidates its entry.
+    """
+
+    def __init__(self, build_dirpath):
+        import threading
+
+        self.build_dirpath = build_dirpath
+        self.lock = threading.Lock()
+        # path -> {'size', 'mtime', 'sha256', 'content'}
+        self.entries = {}
+        self.reads = 0
+        self.hits = 0
+
+    def get(self, path):
+        """{'size', 'mtime', 'sha256', 'content'} of build file `path`."""
+        file_path = os.path.join(self.build_dirpath, path)
+        stat = os.stat(file_path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                self.hits += 1
+                return entry
+        with open(file_path, 'r') as f:
+            content = f.read()
+        entry = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'sha256': Cache.hash(content),
+            'content': content,
+        }
+        with self.lock:
+            self.entries[path] = entry
+            self.reads += 1
+        return entry
+
+
+# https://github.com/kangax/html-minifier#options-quick-reference
+HTML_MINIFIER_ARGS = [
+    '--minify-css', 'true',
+    '--minify-js', 'true',
+    '--minify-urls', 'true',
+    '--collapse-whitespace',
+    '--conservative-collapse',
+    '--remove-comments',
+    # '--decode-entities',
+    '--case-sensitive',
+    # '--remove-optional-tags',
+    '--sort-attributes',
+    '--sort-class-name',
+    '--trim-custom-fragments',
+    '--use-short-doctype',
+    # '--remove-empty-attributes',
+    # '--remove-attribute-quotes',
+]
+# the same settings as `HTML_MINIFIER_ARGS`, for the sidecar
+HTML_MINIFIER_OPTIONS = {
+    'minifyCSS': True,
+    'minifyJS': True,
+    'minifyURLs': True,
+    'collapseWhitespace': True,
+    'conservativeCollapse': True,
+    'removeComments': True,
+    'caseSensitive': True,
+    'sortAttributes': True,
+    'sortClassName': True,
+    'trimCustomFragments': True,
+    'useShortDoctype': True,
+}
+
+HTML_VALIDATE_ARGS = [
+    '--rule=doctype-style:off',
+]
+HTML_VALIDATE_OPTIONS = {
+    'extends': ['html-validate:recommended'],
+    'rules': {
+        'doctype-style': 'off',
+    },
+}
+
+CLEANCSS_ARGS = []
+CLEANCSS_OPTIONS = {}
+
+UGLIFYJS_ARGS = [
+    '--validate',
+]
+# the cli does not compress or mangle unless asked to
+UGLIFYJS_OPTIONS = {
+    'compress': False,
+    'mangle': False,
+    'validate': True,
+}
+
+
+def run_tool(log, args, input=None):
+    """Runs a cli tool and writes its output to `log`.
+    With `input`, the tool reads `input` on stdin and its stdout is returned in `p.stdout`
+    instead, only its stderr goes to `log`."""
+    import subprocess
+
+    if input is not None:
+        p = subprocess.run(
+            args,
+            input=input,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding='utf-8'
+        )
+        if p.stderr:
+            log.write(p.stderr)
+        return p
+
+    p = subprocess.run(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True
+    )
+    if p.stdout:
+        log.write(p.stdout)
+    return p
+
+
+class Sidecar:
+    """One `sidecar.js` node process. Not thread safe; `Tools` hands each one to a single task at a time.
+    """
+
+    def __init__(self, env):
+        import subprocess
+        import json
+
+        self.p = subprocess.Popen(
+            ['node', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sidecar.js')],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+            text=True,
+            encoding='utf-8'
+        )
+        self.next_id = 0
+
+        line = self.p.stdout.readline()
+        hello = json.loads(line) if line else {'ready': False, 'error': 'node exited'}
+        if not hello['ready']:
+            self.close()
+            raise RuntimeError(hello['error'])
+        self.versions = hello['versions']
+
+    def call(self, tool, input, filename, options):
+        import json
+
+        self.next_id += 1
+        self.p.stdin.write(json.dumps({
+            'id': self.next_id,
+            'tool': tool,
+            'filename': filename,
+            'input': input,
+            'options': options,
+        }) + '\n')
+        self.p.stdin.flush()
+        line = self.p.stdout.readline()
+        if not line:
+            raise RuntimeError(f'Sidecar exited while running {tool} on "{filename}"')
+        response = json.loads(line)
+        assert response['id'] == self.next_id
+        return response
+
+    def close(self):
+        self.p.stdin.close()
+        self.p.wait()
+
+
+class Tools:
+    """Runs html-minifier, html-validate, cleancss and uglifyjs.
+
+    With `sidecar`, each worker borrows a long-lived `Sidecar` so there is no node start-up per file.
+    When node cannot load the tools, this falls back to one cli process per file.
+    """
+
+    def __init__(self, sidecar=True, cache=None, profile=None):
+        import threading
+
+        self.sidecar = sidecar
+        self.cache = cache
+        self.profile = profile or Profile()
+        self.lock = threading.Lock()
+        self.idle = []
+        self.sidecars = []
+        self.env = None
+        self.versions = {}
+
+    def start(self):
+        """Starts the first sidecar, or falls back to the cli."""
+        if not self.sidecar:
+            return
+        self.env = self._sidecar_env()
+        try:
+            self.profile.count('sidecar processes')
+            sidecar = Sidecar(self.env)
+        except (OSError, RuntimeError) as e:
+            sys.stdout.write(f'Sidecar unavailable, running the node tools per file ({e})\n')
+            self.sidecar = False
+            return
+        self.sidecars.append(sidecar)
+        self.idle.append(sidecar)
+        self.versions.update(sidecar.versions)
+        versions = ', '.join(f'{tool} {version}' for tool, version in sidecar.versions.items())
+        sys.stdout.write(f'Sidecar running {versions}\n')
+
+    def _checkout(self):
+        if not self.sidecar:
+            return None
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        self.profile.count('sidecar processes')
+        sidecar = Sidecar(self.env)
+        with self.lock:
+            self.sidecars.append(sidecar)
+        return sidecar
+
+    def _checkin(self, sidecar):
+        with self.lock:
+            self.idle.append(sidecar)
+
+    def _sidecar_env(self):
+        import subprocess
+        import shutil
+
+        env = dict(os.environ)
+        # the tools are installed with `npm install -g`
+        npm = shutil.which('npm')
+        if npm:
+            p = subprocess.run([npm, 'root', '-g'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            if p.returncode == 0 and p.stdout.strip():
+                env['NODE_PATH'] = os.pathsep.join(filter(None, [p.stdout.strip(), env.get('NODE_PATH')]))
+        return env
+
+    def _call(self, log, tool, input, filename, options):
+        """Returns the sidecar response, or `None` if the cli should be used."""
+        try:
+            sidecar = self._checkout()
+            if sidecar is None:
+                return None
+            response = sidecar.call(tool, input, filename, options)
+        except (OSError, ValueError, RuntimeError) as e:
+            log.error(f'Error: {e}\n\n')
+            sys.exit(1)
+        self._checkin(sidecar)
+        if response['messages']:
+            log.write('\n' + '\n'.join(response['messages']) + '\n')
+        return response
+
+    def close(self):
+        with self.lock:
+            for sidecar in self.sidecars:
+                sidecar.close()
+            self.sidecars.clear()
+            self.idle.clear()
+
+    def using(self, cache, profile):
+        """A `Tools` that shares the sidecars and tool versions of this one,
+        but caches into `cache` and records into `profile`."""
+        import copy
+
+        tools = copy.copy(self)
+        tools.cache = cache
+        tools.profile = profile
+        return tools
+
+    def version(self, tool):
+        """The tool version, part of every cache key."""
+        with self.lock:
+            if tool not in self.versions:
+                p = self._run_tool(TaskLog(), [tool, '--version'])
+                self.versions[tool] = p.stdout.strip() if p.returncode == 0 else 'unknown'
+            return self.versions[tool]
+
+    def _run_tool(self, log, args, input=None):
+        self.profile.count('tool processes')
+        return run_tool(log, args, input=input)
+
+    def _cached(self, log, stage, tool, options, input, out_path, run):
+        """Runs `run()` unless the output for `input` is in the cache. Failures are not cached.
+        Timed as a `stage` span of the profile."""
+        with self.profile.span(stage, out_path, tool=tool, bytes_in=len(input.encode('utf-8'))) as span:
+            if self.cache is None:
+                output = run()
+            else:
+                key = Cache.key(tool, self.version(tool), options, Cache.hash(input))
+                output = self.cache.get(key)
+                span['cached'] = output is not None
+                self.profile.count(f'{tool} cache {"hits" if output is not None else "misses"}')
+                if output is not None:
+                    log.write(' (cached)')
+                else:
+                    output = run()
+                    if output is not None:
+                        self.cache.put(key, output)
+            span['bytes_out'] = len(output.encode('utf-8')) if output else 0
+        return output
+
+    def minify_html(self, log, html, out_path):
+        """Returns the minified html, or `None` if minification failed."""
+        return self._cached(log, 'minify', 'html-minifier', HTML_MINIFIER_OPTIONS, html, out_path, lambda: self._minify_html(log, html, out_path))
+
+    def validate_html(self, log, html, out_path):
+        """Whether `html` is valid. `out_path` names the page in the messages."""
+        # a valid result is cached as an empty output
+        return self._cached(log, 'validate', 'html-validate', HTML_VALIDATE_OPTIONS, html, out_path, lambda: self._validate_html(log, html, out_path)) is not None
+
+    def minify_css(self, log, css, out_path):
+        """Returns the minified css, or `None` if the css is not valid."""
+        return self._cached(log, 'minify', 'cleancss', CLEANCSS_OPTIONS, css, out_path, lambda: self._minify_css(log, css, out_path))
+
+    def minify_js(self, log, js, out_path):
+        """Returns the minified js, or `None` if the js is not valid."""
+        return self._cached(log, 'minify', 'uglifyjs', UGLIFYJS_OPTIONS, js, out_path, lambda: self._minify_js(log, js, out_path))
+
+    def _minify_html(self, log, html, out_path):
+        response = self._call(log, 'html-minifier', html, out_path, HTML_MINIFIER_OPTIONS)
+        if response is not None:
+            return response['output'] if response['ok'] else None
+
+        p = self._run_tool(log, ['html-minifier'] + HTML_MINIFIER_ARGS, input=html)
+        return p.stdout if p.returncode == 0 else None
+
+    def _validate_html(self, log, html, out_path):
+        response = self._call(log, 'html-validate', html, out_path, HTML_VALIDATE_OPTIONS)
+        if response is not None:
+            return '' if response['ok'] else None
+
+        p = self._run_tool(log, ['html-validate'] + HTML_VALIDATE_ARGS + ['--stdin', f'--stdin-filename={out_path}'], input=html)
+        # the report is on stdout
+        if p.stdout:
+            log.write(p.stdout)
+        return '' if p.returncode == 0 else None
+
+    def _minify_css(self, log, css, out_path):
+        response = self._call(log, 'cleancss', css, out_path, CLEANCSS_OPTIONS)
+        if response is not None:
+            return response['output'] if response['ok'] else None
+
+        p = self._run_tool(log, ['cleancss'] + CLEANCSS_ARGS, input=css)
+        return p.stdout if p.returncode == 0 else None
+
+    def _minify_js(self, log, js, out_path):
+        response = self._call(log, 'uglifyjs', js, out_path, UGLIFYJS_OPTIONS)
+        if response is not None:
+            return response['output'] if response['ok'] else None
+
+        p = self._run_tool(log, ['uglifyjs'] + UGLIFYJS_ARGS, input=js)
+        return p.stdout if p.returncode == 0 else None
+
+
+class BuildPool:
+    """The workers that the builds of several sites in one process share:
+    the task threads, the node tool sidecars and the processes for cpu bound work.
+    """
+
+    def __init__(self, jobs=1, sidecar=True):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.jobs = jobs
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.tools = Tools(sidecar=sidecar)
+        self.tools.start()
+        self.lock = threading.Lock()
+        self._process_executor = None
+        # the builds write their summaries one site at a time
+        self.report_lock = threading.Lock()
+
+    def process_executor(self):
+        """A process pool for cpu bound work that holds the GIL, e.g. Pillow encoding and brotli.
+        Its workers start on the first submit."""
+        with self.lock:
+            if self._process_executor is None:
+                self._process_executor = process_pool(self.jobs)
+            return self._process_executor
+
+    def close(self):
+        self.executor.shutdown()
+        self.tools.close()
+        if self._process_executor is not None:
+            self._process_executor.shutdown()
+
+
+def build(dirpath, minify=True, validate=True, jobs=1, sidecar=True, cache=True, materialize='copy', store_dirpath=None,
+        compress_outputs=False, fingerprint=False, single_pass=False, critical_css=False, purge_css=False,
+        optimize_images=False, subset_fonts=False, bundle_assets=False, enforce_budgets=False, pack=False, check_links=False, profile_render=False, keep=None, serve=False,
+        pool=None):
+    """Builds the site of `dirpath/gen.py`.
+    With `keep`, only the newest `keep` builds and the linked build are kept.
+    `pool` is a `BuildPool` shared with the builds of other sites, by default the build has its own."""
+    import io
+    import json
+    import threading
     import time
-    from jinja2 import Environment, FileSystemLoader, select_autoescape
+    from jinja2 import meta
     import shutil
 
     timestamp = int(time.time())
+    # builds that start in the same second get a sequence number
     build_root_dirname = f'build.{timestamp}'
+    sequence = 0
+    while True:
+        try:
+            os.mkdir(os.path.join(dirpath, build_root_dirname))
+            break
+        except FileExistsError:
+            sequence += 1
+            build_root_dirname = f'build.{timestamp}.{sequence}'
     build_root_dirpath = os.path.join(dirpath, build_root_dirname)
-    build_dirname = os.path.join(build_root_dirname, "build")
     build_dirpath = os.path.join(build_root_dirpath, 'build')
 
-    jinja_env = Environment(
-        loader=FileSystemLoader(dirpath),
-        autoescape=select_autoescape()
-    )
+    import importlib.util
 
     sys.path.append(dirpath)
-    import gen
+    # each site gets its own module, so several sites can build in one process
+    gen_name = f'webgen_gen_{Cache.hash(os.path.abspath(dirpath))[:16]}'
+    gen_spec = importlib.util.spec_from_file_location(gen_name, os.path.join(dirpath, 'gen.py'))
+    gen = importlib.util.module_from_spec(gen_spec)
+    sys.modules[gen_name] = gen
+    gen_spec.loader.exec_module(gen)
     exported_symbols = {
         name: gen.__dict__[name]
         for name in dir(gen)
         if not name.startswith('_')
     }
-    jinja_env.globals.update(exported_symbols)
     # export variables into the gen module
     gen.build_dirpath = build_dirpath
 
-    def process_j2(parent_dirpath, process_filename):
+    # the gen module fields are shared by all templates,
+    # so rendering is serialized while the external tools run concurrently
+    render_lock = threading.Lock()
+
+    profile = Profile()
+    # cProfile of the jinja render path, which runs one template at a time under `render_lock`
+    render_profiler = None
+    if profile_render:
+        import cProfile
+        render_profiler = cProfile.Profile()
+
+    build_cache = Cache(os.path.join(dirpath, CACHE_DIRNAME)) if cache else None
+    template_cache = TemplateCache(os.path.join(dirpath, CACHE_DIRNAME), profile=profile) if cache else None
+    jinja_env = template_env(dirpath, bytecode_cache=template_cache)
+    jinja_env.globals.update(exported_symbols)
+    own_pool = pool is None
+    if own_pool:
+        pool = BuildPool(jobs=jobs, sidecar=(sidecar and (minify or validate)))
+    tools = pool.tools.using(build_cache, profile)
+
+    materializer = Materializer(
+        materialize,
+        store_dirpath or os.path.join(dirpath, CACHE_DIRNAME, 'store'),
+        hashes_path=os.path.join(dirpath, CACHE_DIRNAME, 'hashes.json') if cache else None
+    )
+
+    # template path -> what the last render read, see `template_deps`
+    render_deps = {}
+    rendering = []
+
+    build_files = BuildFiles(build_dirpath)
+
+    def read_build_file(path):
+        entry = build_files.get(path)
+        if rendering:
+            rendering[-1]['resources'][path] = entry['sha256']
+        return entry['content']
+
+    def build_file_info(path):
+        """{'size', 'sha256'} of a processed build file, e.g. to decide whether to inline it."""
+        entry = build_files.get(path)
+        if rendering:
+            rendering[-1]['resources'][path] = entry['sha256']
+        return {
+            'size': entry['size'],
+            'sha256': entry['sha256'],
+        }
+
+    gen.read_build_file = read_build_file
+    gen.build_file_info = build_file_info
+    jinja_env.globals['build_file_info'] = build_file_info
+
+    # build path -> the build path the site uses instead, e.g. a font subset stylesheet
+    substitutes = {}
+    # build path -> fingerprinted build path, filled in before the final phase
+    fingerprints = {}
+
+    def served_path(path):
+        path = substitutes.get(path, path)
+        return fingerprints.get(path, path)
+
+    def asset_url(path):
+        return f'/{served_path(path)}'
+
+    gen.asset_url = asset_url
+    gen.load_manifest = load_manifest
+    gen.load_preloads = load_preloads
+    jinja_env.globals['asset_url'] = asset_url
+
+    def inline_css(path):
+        """A `<style>` element with the processed stylesheet `path`.
+        With `critical_css` this is a placeholder that `inline_critical_css` fills in."""
+        content = read_build_file(served_path(path))
+        if critical_css:
+            return f'<style {CRITICAL_CSS_ATTR}="{path}"></style>'
+        return f'<style>{content}</style>'
+
+    gen.inline_css = inline_css
+    jinja_env.globals['inline_css'] = inline_css
+
+    if optimize_images:
+        try:
+            import PIL
+            pillow_version = PIL.__version__
+        except ImportError:
+            sys.stdout.write('Pillow is not installed (pip install pillow), images are copied as is\n')
+            optimize_images = False
+
+    image_executor = pool.process_executor() if optimize_images else None
+
+    if subset_fonts:
+        try:
+            import fontTools
+            fonttools_version = fontTools.version
+        except ImportError:
+            sys.stdout.write('fontTools is not installed (pip install fonttools), fonts are not subset\n')
+            subset_fonts = False
+
+    # gen `images`, the source globs to write variants of and their widths
+    image_config = getattr(gen, 'images', {})
+    # image build path -> {'width', 'height', 'variants': {format: [(width, variant build path)]}}
+    images = {}
+
+    def picture(path, alt, sizes='100vw', attrs=''):
+        """A `<picture>` with the `--images` variants of the image `path` as `srcset`s,
+        or just the `<img>` when there are none."""
+        from html import escape
+
+        image = images.get(path)
+        img_attrs = [f'src="{asset_url(path)}"', f'alt="{escape(alt)}"']
+        if image:
+            img_attrs.append(f'width="{image["width"]}" height="{image["height"]}"')
+        if attrs:
+            img_attrs.append(attrs)
+        img = f'<img {" ".join(img_attrs)}>'
+        if not image or not any(image['variants'].values()):
+            return img
+        sources = []
+        for image_format in IMAGE_FORMATS:
+            variants = image['variants'].get(image_format)
+            if variants:
+                srcset = ', '.join(f'{asset_url(variant_path)} {width}w' for width, variant_path in variants)
+                sources.append(f'<source type="image/{image_format}" srcset="{srcset}" sizes="{sizes}">')
+        return f'<picture>{"".join(sources)}{img}</picture>'
+
+    gen.picture = picture
+    jinja_env.globals['picture'] = picture
+
+    # gen `bundles`, bundle build path -> {'files': [build paths], 'load': one of `BUNDLE_LOADS`}
+    # an `idle` bundle can wait `delay` ms more, only when the js expression `delay_if` is true if it has one
+    bundle_config = getattr(gen, 'bundles', {})
+    for name, config in bundle_config.items():
+        ext = os.path.splitext(name)[1]
+        if ext not in ['.css', '.js'] or not config.get('files') or any(os.path.splitext(path)[1] != ext for path in config['files']):
+            print(f'Error: bundle "{name}" must be a .css or .js with files of the same type\n', file=sys.stderr)
+            sys.exit(1)
+        if config.get('load', 'eager') not in BUNDLE_LOADS:
+            print(f'Error: bundle "{name}" load must be one of {", ".join(BUNDLE_LOADS)}\n', file=sys.stderr)
+            sys.exit(1)
+        if ('delay' in config or 'delay_if' in config) and (config.get('load') != 'idle' or not isinstance(config.get('delay'), int)):
+            print(f'Error: bundle "{name}" delay must be a number of ms on an idle bundle\n', file=sys.stderr)
+            sys.exit(1)
+    # gen `budgets`, page build path glob -> {one of `BUDGET_LIMITS`: max}
+    budget_config = getattr(gen, 'budgets', {})
+    for pattern, limits in budget_config.items():
+        for limit in limits:
+            if limit not in BUDGET_LIMITS:
+                print(f'Error: budget "{pattern}" limit must be one of {", ".join(BUDGET_LIMITS)}\n', file=sys.stderr)
+                sys.exit(1)
+
+    # the render that has the `BUNDLE_LOADER_SCRIPT`, so each page gets it once
+    loader_rendering = [None]
+
+    def bundle(name, inline=False):
+        """The elements that load the gen `bundles` entry `name` the way it declares, or inline it.
+        Without `bundle_assets` they load the files of the bundle one by one, in the same way."""
+        config = bundle_config[name]
+        paths = [name] if bundle_assets else config['files']
+        load = config.get('load', 'eager')
+        if name.endswith('.css'):
+            if inline:
+                return ''.join(inline_css(path) for path in paths)
+            if load == 'eager':
+                return ''.join(f'<link rel="stylesheet" href="{asset_url(path)}">' for path in paths)
+            if load == 'defer':
+                return ''.join(
+                    f'<link rel="preload" href="{asset_url(path)}" as="style" onload="this.onload=null;this.rel=\'stylesheet\'">'
+                    f'<noscript><link rel="stylesheet" href="{asset_url(path)}"></noscript>'
+                    for path in paths
+                )
+        else:
+            if inline:
+                return ''.join(f'<script>{read_build_file(path)}</script>' for path in paths)
+            if load == 'eager':
+                return ''.join(f'<script src="{asset_url(path)}"></script>' for path in paths)
+            if load == 'defer':
+                return ''.join(f'<script src="{asset_url(path)}" defer></script>' for path in paths)
+
+        loader = ''
+        current = rendering[-1] if rendering else None
+        if current is None or loader_rendering[0] is not current:
+            loader_rendering[0] = current
+            loader = BUNDLE_LOADER_SCRIPT
+        urls = [asset_url(path) for path in paths]
+        delay = config.get('delay', 0)
+        if 'delay_if' in config:
+            delay = f'({config["delay_if"]})?{delay}:0'
+        return f'{loader}<script>webgenLoad({json.dumps(urls)},{delay})</script>'
+
+    gen.bundle = bundle
+    jinja_env.globals['bundle'] = bundle
+
+    # font build path -> the `--subset-fonts` subset that the browser loads instead for the site's text
+    font_subsets = {}
+
+    def preload(path, sizes='100vw'):
+        """A `<link rel=preload>` of the build file `path` for the page's `<head>`, e.g. a font or the first image.
+        A font preloads its subset, and an image with `--images` variants the srcset of the first format."""
+        from html import escape
+
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in PRELOAD_TYPES:
+            print(f'Error: preload "{path}" is not a stylesheet, script, font or image\n', file=sys.stderr)
+            sys.exit(1)
+        as_type, content_type = PRELOAD_TYPES[ext]
+        if as_type == 'font':
+            path = font_subsets.get(path, path)
+            return f'<link rel="preload" href="{asset_url(path)}" as="font" type="{content_type}" crossorigin>'
+        image = images.get(path)
+        if as_type == 'image' and image:
+            for image_format in IMAGE_FORMATS:
+                variants = image['variants'].get(image_format)
+                if variants:
+                    srcset = ', '.join(f'{asset_url(variant_path)} {width}w' for width, variant_path in variants)
+                    # a browser without the format skips the preload, like the `<source>`
+                    return (
+                        f'<link rel="preload" as="image" type="image/{image_format}" '
+                        f'imagesrcset="{escape(srcset)}" imagesizes="{escape(sizes)}">'
+                    )
+        if content_type:
+            return f'<link rel="preload" href="{asset_url(path)}" as="{as_type}" type="{content_type}">'
+        return f'<link rel="preload" href="{asset_url(path)}" as="{as_type}">'
+
+    gen.preload = preload
+    jinja_env.globals['preload'] = preload
+
+    # page build path -> `head_preloads` of the page, for the `Link` headers of `load_preloads`.
+    # also the pages that the budget weighs
+    page_preloads = {}
+
+    # page build path -> {stylesheet path: {'before', 'after'}} inlined bytes
+    critical_css_report = {}
+    # stylesheet sha256 -> `parse_css` rules
+    parsed_css = {}
+
+    def inline_critical_css(log, page_html, out_path):
+        """Inlines only the rules of each `inline_css` stylesheet that the page's html can match,
+        and loads the full stylesheet asynchronously for everything added later by scripts."""
+        import re
+
+        placeholder_re = re.compile(f'<style {CRITICAL_CSS_ATTR}="([^"]*)"></style>')
+        if not placeholder_re.search(page_html):
+            return page_html
+
+        usage = CssUsage()
+        content_html = placeholder_re.sub('', page_html)
+        usage.add_html(content_html)
+
+        # fonts and animations can be declared in one stylesheet and used in another,
+        # or in a style attribute, so references are resolved over the whole page
+        sheets = {}
+        for path in placeholder_re.findall(page_html):
+            entry = build_files.get(served_path(path))
+            rules = parsed_css.get(entry['sha256'])
+            if rules is None:
+                rules = parse_css(entry['content'])
+                parsed_css[entry['sha256']] = rules
+            sheets[path] = (entry, filter_css_selectors(rules, usage))
+        declarations = '\n'.join([content_html] + [css_declarations(rules) for _, rules in sheets.values()])
+
+        report = {}
+
+        def replace_placeholder(m):
+            path = m.group(1)
+            entry, rules = sheets[path]
+            critical = serialize_css(filter_css_references(rules, declarations))
+            report[path] = {
+                'before': entry['size'],
+                'after': len(critical.encode('utf-8')),
+            }
+            url = asset_url(path)
+            html = f'<style>{critical}</style>' if critical else ''
+            return html + (
+                f'<link rel="preload" href="{url}" as="style" onload="this.onload=null;this.rel=\'stylesheet\'">'
+                f'<noscript><link rel="stylesheet" href="{url}"></noscript>'
+            )
+
+        page_html = placeholder_re.sub(replace_placeholder, page_html)
+        critical_css_report[os.path.relpath(out_path, build_dirpath)] = report
+
+        before = sum(r['before'] for r in report.values())
+        after = sum(r['after'] for r in report.values())
+        log.write(f' (inlined css {before} -> {after} bytes)')
+        return page_html
+
+    def template_deps(template_path):
+        """The template and every template it includes, imports or extends."""
+        deps = {}
+        pending = [template_path]
+        while pending:
+            name = pending.pop()
+            if name in deps:
+                continue
+            source, _, _ = jinja_env.loader.get_source(jinja_env, name)
+            deps[name] = Cache.hash(source)
+            # dynamic names come back as `None`
+            pending.extend(
+                ref
+                for ref in meta.find_referenced_templates(jinja_env.parse(source))
+                if ref is not None
+            )
+        return deps
+
+    def render(template_path, **kwargs):
+        """Renders while recording the templates and build files the output depends on.
+        Callers hold `render_lock`."""
+        rendering.append({
+            'templates': template_deps(template_path),
+            'resources': {},
+        })
+        with profile.span('render', template_path) as span:
+            if render_profiler is not None:
+                render_profiler.enable()
+            try:
+                output = jinja_env.get_template(template_path).render(**kwargs)
+            finally:
+                if render_profiler is not None:
+                    render_profiler.disable()
+                render_deps[template_path] = rendering.pop()
+            span['bytes_out'] = len(output.encode('utf-8'))
+        return output
+
+    def process_j2(log, phase, parent_dirpath, process_filename):
         file_name = process_filename[:-len(j2_suffix)]
         out_path = os.path.join(build_dirpath, parent_dirpath, f'{file_name}')
 
-        sys.stdout.write(f'[{gen.build_phase}] Processing {out_path} ...')
-        sys.stdout.flush()
-        
-        gen.file_name = file_name
-        template = jinja_env.get_template(os.path.join(parent_dirpath, process_filename))
-        file_content = template.render(
-            file_name=file_name
-        )
+        log.write(f'[{phase}] Processing {out_path} ...')
 
-        with open(out_path, 'w') as f:
-            f.write(file_content)
-        
-        sys.stdout.write(' done.\n')
+        with render_lock:
+            gen.build_phase = phase
+            gen.file_name = file_name
+            file_content = render(
+                os.path.join(parent_dirpath, process_filename),
+                file_name=file_name
+            )
+
+        write_file(out_path, file_content)
 
-    def process_page(parent_dirpath, process_filename):
+        log.write(' done.\n')
+
+    def process_page(log, phase, parent_dirpath, process_filename):
         page_name = process_filename[:-len(page_suffix)]
         page_path = os.path.join(parent_dirpath, page_name)
         out_path = os.path.join(build_dirpath, parent_dirpath, f'{page_name}.html')
 
-        sys.stdout.write(f'[{gen.build_phase}] Processing {out_path} ...')
-        sys.stdout.flush()
-        
-        gen.page_name = page_name
-        gen.page_path = page_path
-        template = jinja_env.get_template(os.path.join(parent_dirpath, process_filename))
-        page_html = template.render(
-            page_name=page_name,
-            page_path=page_path
-        )
-        
+        log.write(f'[{phase}] Processing {out_path} ...')
+
+        with render_lock:
+            gen.build_phase = phase
+            gen.page_name = page_name
+            gen.page_path = page_path
+            page_html = render(
+                os.path.join(parent_dirpath, process_filename),
+                page_name=page_name,
+                page_path=page_path
+            )
+
+        if critical_css:
+            with profile.span('critical-css', out_path, bytes_in=len(page_html.encode('utf-8'))) as span:
+                page_html = inline_critical_css(log, page_html, out_path)
+                span['bytes_out'] = len(page_html.encode('utf-8'))
+
         if minify:
-            with open(os.path.join(build_dirpath, parent_dirpath, f'{page_name}.html.tmp'), 'w') as f:
-                f.write(page_html)
-            
-            sys.stdout.write(f'...')
-            sys.stdout.flush()
-            p = subprocess.run([
-                'html-minifier',
-                '--minify-css', 'true',
-                '--minify-js', 'true',
-                '--minify-urls', 'true',
-                '--collapse-whitespace',
-                '--conservative-collapse',
-                '--remove-comments',
-                # '--decode-entities',
-                '--case-sensitive',
-                # '--remove-optional-tags',
-                '--sort-attributes',
-                '--sort-class-name',
-                '--trim-custom-fragments',
-                '--use-short-doctype',
-                # '--remove-empty-attributes',
-                # '--remove-attribute-quotes',
-                '-o', out_path,
-                os.path.join(build_dirpath, parent_dirpath, f'{page_name}.html.tmp')
-            ])
-            os.remove(os.path.join(build_dirpath, parent_dirpath, f'{page_name}.html.tmp'))
-        else:
-            with open(out_path, 'w') as f:
-                f.write(page_html)
+            log.write(f'...')
+            page_html = tools.minify_html(log, page_html, out_path)
+            if page_html is None:
+                log.error(f'Error: "{out_path}" could not be minified\n\n')
+                sys.exit(1)
 
         if validate:
-            sys.stdout.write(f'...')
-            sys.stdout.flush()
-            p = subprocess.run([
-                'html-validate',
-                '--rule=doctype-style:off',
-                out_path
-            ])
-            if p.returncode == 0:
-                sys.stdout.write(' valid')
-                sys.stdout.flush()
+            log.write(f'...')
+            if tools.validate_html(log, page_html, out_path):
+                log.write(' valid')
             else:
-                print(f'Error: "{out_path}" is not valid\n', file=sys.stderr)
+                log.error(f'Error: "{out_path}" is not valid\n\n')
                 sys.exit(1)
 
-        sys.stdout.write(' done.\n')
+        page_preloads[os.path.relpath(out_path, build_dirpath)] = head_preloads(page_html)
+
+        # the one write of the page, after it is minified and validated in memory
+        write_file(out_path, page_html)
 
-    def process_css(parent_dirpath, process_filename):
+        log.write(' done.\n')
+
+    def process_css(log, phase, parent_dirpath, process_filename):
         if not minify or process_filename.endswith('.min.css'):
-            process_file(parent_dirpath, process_filename)
+            process_file(log, phase, parent_dirpath, process_filename)
             return
 
         out_path = os.path.join(build_dirpath, parent_dirpath, process_filename)
 
-        sys.stdout.write(f'[{gen.build_phase}] Processing {os.path.join(build_dirpath, parent_dirpath, process_filename)} ...')
-        sys.stdout.flush()
-        shutil.copyfile(
-            os.path.join(dirpath, parent_dirpath, process_filename),
-            os.path.join(build_dirpath, parent_dirpath, f'{process_filename}.tmp')
-        )
-        p = subprocess.run([
-            'cleancss',
-            '-o', out_path,
-            os.path.join(build_dirpath, parent_dirpath, f'{process_filename}.tmp')
-        ])
-        if p.returncode != 0:
-            print(f'Error: "{out_path}" is not valid\n', file=sys.stderr)
+        log.write(f'[{phase}] Processing {os.path.join(build_dirpath, parent_dirpath, process_filename)} ...')
+        with open(os.path.join(dirpath, parent_dirpath, process_filename), 'r') as f:
+            content = f.read()
+        content = tools.minify_css(log, content, out_path)
+        if content is None:
+            log.error(f'Error: "{out_path}" is not valid\n\n')
             sys.exit(1)
-        os.remove(os.path.join(build_dirpath, parent_dirpath, f'{process_filename}.tmp'))
-        sys.stdout.write(' done.\n')
+        write_file(out_path, content)
+        log.write(' done.\n')
 
-    def process_js(parent_dirpath, process_filename):
+    def process_js(log, phase, parent_dirpath, process_filename):
         if not minify or process_filename.endswith('.min.js'):
-            process_file(parent_dirpath, process_filename)
+            process_file(log, phase, parent_dirpath, process_filename)
             return
 
         out_path = os.path.join(build_dirpath, parent_dirpath, process_filename)
 
-        sys.stdout.write(f'[{gen.build_phase}] Processing {os.path.join(build_dirpath, parent_dirpath, process_filename)} ...')
-        sys.stdout.flush()
-        shutil.copyfile(
-            os.path.join(dirpath, parent_dirpath, process_filename),
-            os.path.join(build_dirpath, parent_dirpath, f'{process_filename}.tmp')
-        )
-        p = subprocess.run([
-            'uglifyjs',
-            '--validate',
-            '-o', out_path,
-            os.path.join(build_dirpath, parent_dirpath, f'{process_filename}.tmp')
-        ])
-        if p.returncode != 0:
-            print(f'Error: "{out_path}" is not valid\n', file=sys.stderr)
+        log.write(f'[{phase}] Processing {os.path.join(build_dirpath, parent_dirpath, process_filename)} ...')
+        with open(os.path.join(dirpath, parent_dirpath, process_filename), 'r') as f:
+            content = f.read()
+        content = tools.minify_js(log, content, out_path)
+        if content is None:
+            log.error(f'Error: "{out_path}" is not valid\n\n')
             sys.exit(1)
-        os.remove(os.path.join(build_dirpath, parent_dirpath, f'{process_filename}.tmp'))
-        sys.stdout.write(' done.\n')
-
-    def process_file(parent_dirpath, process_filename):
-        sys.stdout.write(f'[{gen.build_phase}] Copy {os.path.join(build_dirpath, parent_dirpath, process_filename)}\n')
-        shutil.copyfile(
-            os.path.join(dirpath, parent_dirpath, process_filename),
-            os.path.join(build_dirpath, parent_dirpath, process_filename)
-        )
+        write_file(out_path, content)
+        log.write(' done.\n')
 
-    def purge_unused_css():
-        css_paths = []
-        content_paths = []
-        for process_dirpath, process_dirnames, process_filenames in os.walk(build_dirpath, topdown=True, followlinks=True):
-            for process_filename in process_filenames:
-                if process_filename.endswith('.css'):
-                    css_paths.append(os.path.join(process_dirpath, process_filename))
-                elif process_filename.endswith('.html') or process_filename.endswith('.js'):
-                    content_paths.append(os.path.join(process_dirpath, process_filename))
-
-        if 0 < len(css_paths) and 0 < len(content_paths):
-            purge_unused_css_path = os.path.join(build_root_dirpath, 'purgecss')
-            os.makedirs(purge_unused_css_path)
-            
-            sys.stdout.write(f'[{gen.build_phase}] Purge {len(css_paths)} css files using {len(content_paths)} content files ...')
-            sys.stdout.flush()
-            p = subprocess.run([
-                'purgecss',
-                '--css'] + css_paths + [
-                '--content'] + content_paths + [
-                '--font-face',
-                '--output', purge_unused_css_path
-            ])
-            sys.stdout.write(' done.\n')
-
-            # copy into place
-            for process_dirpath, process_dirnames, process_filenames in os.walk(build_dirpath, topdown=True, followlinks=True):
-                for process_filename in process_filenames:
-                    if process_filename.endswith('.css'):
-                        purged_css_path = os.path.join(purge_unused_css_path, process_filename)
-                        sys.stdout.write(f'[{gen.build_phase}] Copy {purged_css_path}\n')
-                        shutil.copyfile(
-                            purged_css_path,
-                            os.path.join(process_dirpath, process_filename)
+    def process_file(log, phase, parent_dirpath, process_filename):
+        log.write(f'[{phase}] Copy {os.path.join(build_dirpath, parent_dirpath, process_filename)}')
+        src_path = os.path.join(dirpath, parent_dirpath, process_filename)
+        size = os.path.getsize(src_path)
+        with profile.span('copy', src_path, bytes_in=size, bytes_out=size) as span:
+            method = materializer.materialize(
+                src_path,
+                os.path.join(build_dirpath, parent_dirpath, process_filename)
+            )
+            span['method'] = method
+        if method != 'copy':
+            log.write(f' ({method})')
+        log.write('\n')
+
+    def process_image(log, phase, parent_dirpath, process_filename):
+        import fnmatch
+
+        path = os.path.join(parent_dirpath, process_filename)
+        out_path = os.path.join(build_dirpath, path)
+
+        log.write(f'[{phase}] Optimize {out_path} ...')
+        with open(os.path.join(dirpath, path), 'rb') as f:
+            content = f.read()
+        content_hash = Cache.hash(content)
+
+        def cached(spec, run):
+            if build_cache is None:
+                return run()
+            key = Cache.key('image', spec, pillow_version, content_hash)
+            output = build_cache.get(key, binary=True)
+            profile.count(f'image cache {"hits" if output is not None else "misses"}')
+            if output is None:
+                output = run()
+                build_cache.put(key, output)
+            return output
+
+        ext = os.path.splitext(process_filename)[1].lower()
+        with profile.span('images', out_path, bytes_in=len(content)) as span:
+            optimized = cached(['optimize', ext], lambda: image_executor.submit(optimize_image, content, ext).result())
+            span['bytes_out'] = len(optimized or content)
+        if optimized:
+            write_file(out_path, optimized)
+            log.write(f' {len(content)} -> {len(optimized)} bytes')
+        else:
+            materializer.materialize(os.path.join(dirpath, path), out_path)
+        size = len(optimized or content)
+
+        if any(fnmatch.fnmatch(path, pattern) for pattern in image_config.get('variants', [])):
+            width, height = image_size(content)
+            widths = sorted({w for w in image_config.get('widths', IMAGE_WIDTHS) if w < width} | {width})
+            variants = {}
+            for image_format in IMAGE_FORMATS:
+                variants[image_format] = []
+                for variant_width in widths:
+                    variant_path = image_variant_path(path, variant_width, image_format)
+                    with profile.span('images', os.path.join(build_dirpath, variant_path), bytes_in=len(content)) as span:
+                        variant = cached(
+                            ['variant', image_format, variant_width, IMAGE_QUALITY[image_format]],
+                            lambda: image_executor.submit(image_variant, content, variant_width, image_format).result()
                         )
+                        span['bytes_out'] = len(variant)
+                    # a variant larger than the original is no use to anyone
+                    if len(variant) < size:
+                        write_file(os.path.join(build_dirpath, variant_path), variant)
+                        variants[image_format].append((variant_width, variant_path))
+            images[path] = {
+                'width': width,
+                'height': height,
+                'variants': variants,
+            }
+            log.write(f' {sum(len(v) for v in variants.values())} variants')
+
+        log.write(' done.\n')
+
+    def content_files(patterns):
+        """The sorted source paths that match the globs `patterns`, outside of the builds."""
+        import glob
+
+        content_paths = set()
+        for pattern in patterns:
+            for path in glob.glob(pattern, root_dir=dirpath, recursive=True):
+                top_dirname = path.split(os.sep, 1)[0]
+                if top_dirname.startswith('build') or top_dirname == CACHE_DIRNAME:
+                    continue
+                if os.path.isfile(os.path.join(dirpath, path)):
+                    content_paths.add(path)
+        return sorted(content_paths)
+
+    def process_purge_css(log):
+        """Removes the rules of the `gen.purge_css` stylesheets that no content file can match."""
+        import re
+
+        purge = gen.purge_css
+
+        usage = CssUsage()
+        content_paths = content_files(purge.get('content', []))
+        for path in content_paths:
+            with open(os.path.join(dirpath, path), 'r', errors='replace') as f:
+                usage.add_words(f.read())
+
+        allowlist = [re.compile(pattern) for pattern in purge.get('allowlist', [])]
+
+        def keep_selector(selector):
+            return any(pattern.search(selector) for pattern in allowlist)
+
+        sheets = {}
+        for path in purge.get('stylesheets', []):
+            out_path = os.path.join(build_dirpath, path)
+            if not os.path.isfile(out_path):
+                log.error(f'Error: purge_css stylesheet "{path}" is not in the build\n\n')
+                sys.exit(1)
+            with open(out_path, 'r') as f:
+                css = f.read()
+            with profile.span('purge', out_path, bytes_in=len(css.encode('utf-8'))):
+                sheets[path] = (css, filter_css_selectors(parse_css(css), usage, keep_selector=keep_selector))
+        declarations = '\n'.join(css_declarations(rules) for _, rules in sheets.values())
+
+        before = 0
+        after = 0
+        for path, (css, rules) in sheets.items():
+            out_path = os.path.join(build_dirpath, path)
+            with profile.span('purge', out_path) as span:
+                purged_css = serialize_css(filter_css_references(rules, declarations))
+                span['bytes_out'] = len(purged_css.encode('utf-8'))
+            log.write(f'[purge] {out_path} {len(css.encode("utf-8"))} -> {len(purged_css.encode("utf-8"))} bytes\n')
+            before += len(css.encode('utf-8'))
+            after += len(purged_css.encode('utf-8'))
+            # replaced rather than written in place, the build file may be a hardlink into the store
+            write_file(out_path, purged_css)
+
+        log.write(f'[purge] Purged {len(sheets)} stylesheets using {len(content_paths)} content files, {before} -> {after} bytes\n')
 
 
     # j2_files = [f for f in os.listdir(dirpath) if os.path.isfile(os.path.join(dirpath, f)) and f.endswith('.j2')]
@@ -247,13 +3115,35 @@ def build(dirpath, minify=True, validate=True):
     page_targets = []
     j2_targets = []
 
-    gen.build_phase = 'initial'
+    def task(process, phase, target, deps=()):
+        parent_dirpath, process_filename = target
+        return Task(
+            f'[{phase}] {os.path.join(parent_dirpath, process_filename)}',
+            lambda log: process(log, phase, *target),
+            deps=deps
+        )
+
+    def processor(process_filename):
+        if process_filename.endswith(page_suffix):
+            return process_page
+        elif process_filename.endswith(j2_suffix):
+            return process_j2
+        elif process_filename.endswith('.css'):
+            return process_css
+        elif process_filename.endswith('.js'):
+            return process_js
+        elif optimize_images and os.path.splitext(process_filename)[1].lower() in IMAGE_EXTENSIONS:
+            return process_image
+        else:
+            return process_file
+
+    initial_tasks = []
     for process_dirpath, process_dirnames, process_filenames in os.walk(dirpath, topdown=True, followlinks=True):
         if dirpath == process_dirpath:
             filtered_dirnames = [
                 process_dirname
                 for process_dirname in process_dirnames
-                if not process_dirname.startswith('build') and process_dirname not in ['__pycache__']
+                if not process_dirname.startswith('build') and process_dirname not in ['__pycache__', CACHE_DIRNAME]
             ]
             process_dirnames[:] = filtered_dirnames
             filtered_filenames = [
@@ -270,57 +3160,805 @@ def build(dirpath, minify=True, validate=True):
         
         for process_filename in process_filenames:
             target = (parent_dirpath, process_filename)
+            process = processor(process_filename)
 
-            if process_filename.endswith(page_suffix):
+            if process == process_page:
                 page_targets.append(target)
-                process_page(*target)
-            elif process_filename.endswith(j2_suffix):
+                if single_pass:
+                    continue
+            elif process == process_j2:
                 j2_targets.append(target)
-                process_j2(*target)
-            elif process_filename.endswith('.css'):
-                process_css(*target)
-            elif process_filename.endswith('.js'):
-                process_js(*target)
+                continue
+            initial_tasks.append(task(process, 'initial', target))
+
+    # templates that other templates extend, include or import only render as part of them,
+    # e.g. a layout would read `page_path` before any page sets it
+    partial_names = set()
+    for parent_dirpath, process_filename in page_targets + j2_targets:
+        template_path = os.path.join(parent_dirpath, process_filename)
+        partial_names.update(name for name in template_deps(template_path) if name != template_path)
+    j2_targets = [
+        target
+        for target in j2_targets
+        if os.path.join(*target) not in partial_names
+    ]
+    if not single_pass:
+        initial_tasks.extend(task(process_j2, 'initial', target) for target in j2_targets)
+
+    def process_subset_fonts(log):
+        """Adds a subset of each font of the `gen.subset_fonts` stylesheets with just the text of the content files.
+        The site uses a copy of each stylesheet that declares the subset after the full font,
+        so the browser only downloads the full font for text outside the subset's `unicode-range`.
+        A ligature font is replaced by its subset instead: a word split across two faces draws no ligature,
+        so its icons must appear literally in the content files."""
+        import re
+        import html
+
+        config = gen.subset_fonts
+        ligature_families = config.get('ligatures', {})
+
+        codepoints = set()
+        # font family -> the words drawn as ligatures
+        ligatures = {family: set() for family in ligature_families.values()}
+        content_paths = content_files(config.get('content', []))
+        for path in content_paths:
+            with open(os.path.join(dirpath, path), 'r', errors='replace') as f:
+                content = f.read()
+            text = html.unescape(content)
+            # text-transform can change the case of any text
+            codepoints.update(ord(c) for c in set(text + text.upper() + text.lower()))
+            for class_name, family in ligature_families.items():
+                for m in re.finditer(rf'class="[^"]*\b{re.escape(class_name)}\b[^"]*"[^>]*>([^<]*)<', content):
+                    ligatures[family].update(m.group(1).split())
+
+        # subset build path -> sha256
+        subset_hashes = {}
+        before = 0
+        after = 0
+        for css_path in config.get('stylesheets', []):
+            out_path = os.path.join(build_dirpath, css_path)
+            if not os.path.isfile(out_path):
+                log.error(f'Error: subset_fonts stylesheet "{css_path}" is not in the build\n\n')
+                sys.exit(1)
+            with open(out_path, 'r') as f:
+                css = f.read()
+
+            subset_rules = []
+            for prelude, body in parse_css(css):
+                subset_rules.append((prelude, body))
+                if prelude.lower() != '@font-face' or not isinstance(body, str):
+                    continue
+
+                # collects the paths, `append` returns `None` so nothing is rewritten
+                font_paths = []
+                rewrite_css_urls(body, css_path, font_paths.append)
+                font_paths = [path for path in font_paths if os.path.splitext(path)[1] in SUBSET_FONT_EXTENSIONS]
+                if not font_paths or not os.path.isfile(os.path.join(build_dirpath, font_paths[0])):
+                    continue
+                font_path = font_paths[0]
+
+                m = re.search(r'font-family\s*:\s*([^;]+)', body)
+                family = m.group(1).strip().strip('\'"') if m else None
+                font_ligatures = sorted(ligatures.get(family, []))
+                if family in ligatures:
+                    # an icon font is only used for its ligature words
+                    font_codepoints = {ord(c) for word in font_ligatures for c in word}
+                else:
+                    font_codepoints = codepoints
+                m = re.search(r'unicode-range\s*:\s*([^;]+)', body)
+                if m:
+                    font_codepoints = font_codepoints & parse_unicode_range(m.group(1))
+                font_codepoints = sorted(font_codepoints)
+                if not font_codepoints:
+                    continue
+
+                with open(os.path.join(build_dirpath, font_path), 'rb') as f:
+                    font = f.read()
+
+                def run():
+                    return subset_font(font, font_codepoints, font_ligatures)
+
+                with profile.span('fonts', os.path.join(build_dirpath, font_path), bytes_in=len(font)) as span:
+                    if build_cache is None:
+                        subset = run()
+                    else:
+                        key = Cache.key('font-subset', fonttools_version, font_codepoints, font_ligatures, Cache.hash(font))
+                        subset = build_cache.get(key, binary=True)
+                        profile.count(f'font cache {"hits" if subset is not None else "misses"}')
+                        if subset is None:
+                            subset = run()
+                            build_cache.put(key, subset)
+                    span['bytes_out'] = len(subset)
+                if not subset or len(font) <= len(subset):
+                    continue
+
+                root, _ = os.path.splitext(font_path)
+                subset_path = f'{root}.subset.woff2'
+                # the same font can be subset for different text by another rule
+                if subset_hashes.setdefault(subset_path, Cache.hash(subset)) != Cache.hash(subset):
+                    subset_path = f'{root}.subset-{Cache.hash(subset)[:8]}.woff2'
+                write_file(os.path.join(build_dirpath, subset_path), subset)
+                font_subsets.setdefault(font_path, subset_path)
+                log.write(f'[fonts] {os.path.join(build_dirpath, subset_path)} {len(font)} -> {len(subset)} bytes\n')
+                before += len(font)
+                after += len(subset)
+
+                subset_body = re.sub(r'src\s*:[^;]*;?', f"src: url('/{subset_path}') format('woff2');", body, count=1)
+                if family in ligatures:
+                    subset_rules[-1] = (prelude, subset_body)
+                    continue
+                subset_body = re.sub(r'unicode-range\s*:[^;]*;?', '', subset_body).rstrip().rstrip(';')
+                subset_body = f'{subset_body}; unicode-range: {unicode_range(font_codepoints)};'
+                # the last matching face is tried first
+                subset_rules.append((prelude, subset_body))
+
+            root, ext = os.path.splitext(css_path)
+            subset_css_path = f'{root}.subset{ext}'
+            write_file(os.path.join(build_dirpath, subset_css_path), serialize_css(subset_rules))
+            substitutes[css_path] = subset_css_path
+
+        log.write(f'[fonts] Subset fonts of {len(config.get("stylesheets", []))} stylesheets using {len(content_paths)} content files, {before} -> {after} bytes\n')
+
+    def process_bundles(log):
+        """Concatenates the processed files of each gen `bundles` entry into the bundle's build path.
+        The files were minified one by one, and are cached that way, so the bundle is not minified again."""
+        for name, config in bundle_config.items():
+            out_path = os.path.join(build_dirpath, name)
+            contents = []
+            for path in config['files']:
+                # e.g. the font subset stylesheet
+                path = substitutes.get(path, path)
+                if not os.path.isfile(os.path.join(build_dirpath, path)):
+                    log.error(f'Error: bundle "{name}" file "{path}" is not in the build\n\n')
+                    sys.exit(1)
+                with open(os.path.join(build_dirpath, path), 'r') as f:
+                    content = f.read()
+                if name.endswith('.css'):
+                    # the bundle can be in another directory, so relative urls become absolute
+                    content = rewrite_css_urls(content, path, lambda url_path: f'/{url_path}')
+                contents.append(content)
+            # a file can end in a line comment or without a semicolon
+            bundle_content = '\n'.join(contents) if name.endswith('.css') else '\n;\n'.join(contents)
+            size = len(bundle_content.encode('utf-8'))
+            with profile.span('bundle', out_path, bytes_in=sum(len(c.encode('utf-8')) for c in contents), bytes_out=size):
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                write_file(out_path, bundle_content)
+            log.write(f'[bundle] {out_path} {len(contents)} files, {size} bytes\n')
+
+    # only the stylesheets that gen.py declares are purged,
+    # the rest of res/ is also served to other consumers as is
+    purge_tasks = []
+    if purge_css and getattr(gen, 'purge_css', None):
+        purge_tasks.append(Task('[purge]', process_purge_css, deps=initial_tasks))
+
+    # like the purge, only the fonts of the stylesheets that gen.py declares are subset
+    font_tasks = []
+    if subset_fonts and getattr(gen, 'subset_fonts', None):
+        font_tasks.append(Task('[fonts]', process_subset_fonts, deps=initial_tasks))
+
+    # bundles are fingerprinted like any other asset
+    bundle_tasks = []
+    if bundle_assets and bundle_config:
+        bundle_tasks.append(Task('[bundle]', process_bundles, deps=initial_tasks + purge_tasks + font_tasks))
+
+    def process_fingerprints(log):
+        paths = []
+        for process_dirpath, process_dirnames, process_filenames in os.walk(build_dirpath):
+            for process_filename in process_filenames:
+                if os.path.splitext(process_filename)[1] in FINGERPRINT_EXTENSIONS:
+                    paths.append(os.path.relpath(os.path.join(process_dirpath, process_filename), build_dirpath))
+        # stylesheets last, so their urls can point at fingerprinted fonts and images
+        paths.sort(key=lambda path: (path.endswith('.css'), path))
+
+        for path in paths:
+            out_path = os.path.join(build_dirpath, path)
+            with profile.span('fingerprint', out_path):
+                if path.endswith('.css'):
+                    with open(out_path, 'r') as f:
+                        css = f.read()
+                    css = rewrite_css_urls(css, path, fingerprints.get)
+                    fingerprinted_path = fingerprint_path(path, Cache.hash(css))
+                    write_file(os.path.join(build_dirpath, fingerprinted_path), css)
+                else:
+                    fingerprinted_path = fingerprint_path(path, hash_file(out_path))
+                    try:
+                        os.link(out_path, os.path.join(build_dirpath, fingerprinted_path))
+                    except OSError:
+                        shutil.copyfile(out_path, os.path.join(build_dirpath, fingerprinted_path))
+            fingerprints[path] = fingerprinted_path
+
+        log.write(f'[fingerprint] Fingerprinted {len(fingerprints)} assets\n')
+
+    fingerprint_tasks = []
+    if fingerprint:
+        fingerprint_tasks.append(Task('[fingerprint]', process_fingerprints, deps=initial_tasks + purge_tasks + font_tasks + bundle_tasks))
+
+    # the final phase inlines processed resources from `build_dirpath`,
+    # so it starts only after every initial task is done
+    final_deps = initial_tasks + purge_tasks + font_tasks + bundle_tasks + fingerprint_tasks
+    j2_tasks = [
+        task(process_j2, 'final', target, deps=final_deps)
+        for target in j2_targets
+    ]
+    if single_pass:
+        # the initial phase only processed the static files, so templates render once.
+        # other templates run first in case a page reads their output
+        final_deps = final_deps + j2_tasks
+    final_tasks = [
+        task(process_page, 'final', target, deps=final_deps)
+        for target in page_targets
+    ] + j2_tasks
+
+    def close():
+        if template_cache is not None:
+            template_cache.close()
+        if own_pool:
+            pool.close()
+
+    # the summaries of concurrent sites would interleave, so each site's summary is written at once
+    summary = io.StringIO()
+
+    def write_summary():
+        with pool.report_lock:
+            sys.stdout.write(summary.getvalue())
+            sys.stdout.flush()
+
+    def finish():
+        """Writes the reports of the build and links it."""
+        if any(materializer.counts.values()):
+            counts = ', '.join(f'{count} {method}' for method, count in materializer.counts.items() if count)
+            summary.write(f'Materialized {counts}\n')
+
+        if compress_outputs:
+            with profile.span('precompress', build_dirpath):
+                precompress(build_dirpath, pool.process_executor(), summary, cache=build_cache)
+
+        if critical_css_report:
+            before = sum(r['before'] for report in critical_css_report.values() for r in report.values())
+            after = sum(r['after'] for report in critical_css_report.values() for r in report.values())
+            summary.write(f'Critical css inlined {after} of {before} bytes over {len(critical_css_report)} pages\n')
+            write_json(os.path.join(build_root_dirpath, CRITICAL_CSS_REPORT_FILENAME), critical_css_report)
+
+        with profile.span('manifest', build_dirpath):
+            files = add_encodings(file_manifest(build_dirpath))
+
+            # against the build that is linked until this one is
+            previous_build_dirname = linked_build(dirpath)
+            previous_files = {}
+            previous_manifest_path = os.path.join(dirpath, previous_build_dirname or '', MANIFEST_FILENAME)
+            if previous_build_dirname is not None and os.path.isfile(previous_manifest_path):
+                with open(previous_manifest_path, 'r') as f:
+                    previous_files = json.load(f)['files']
             else:
-                process_file(*target)
+                previous_build_dirname = None
+            build_delta = manifest_delta(files, previous_files)
+            build_delta['previous'] = previous_build_dirname
+            write_json(os.path.join(build_root_dirpath, DELTA_FILENAME), build_delta)
+        summary.write(
+            f'Delta against {previous_build_dirname}: {len(build_delta["added"])} added, '
+            f'{len(build_delta["changed"])} changed, {len(build_delta["removed"])} removed, {build_delta["bytes"]} bytes\n'
+        )
+
+        with profile.span('budget', build_dirpath):
+            page_htmls = {}
+            for page_relpath in sorted(page_preloads):
+                with open(os.path.join(build_dirpath, page_relpath), 'r') as f:
+                    page_htmls[page_relpath] = f.read()
+            load_paths = sorted(set(
+                path
+                for page_relpath, page_html in page_htmls.items()
+                for path in page_loads(page_html, page_relpath, files)[0]
+            ))
+            # a build without `--precompress` is weighed as if it had the siblings
+            compressed = compressed_sizes(build_dirpath, load_paths, files, pool.process_executor(), cache=build_cache)
+            budget_report = {
+                page_relpath: page_weight(page_html, page_relpath, files, compressed)
+                for page_relpath, page_html in page_htmls.items()
+            }
+            write_json(os.path.join(build_root_dirpath, BUDGET_REPORT_FILENAME), budget_report)
+        previous_budget_report = {}
+        previous_budget_report_path = os.path.join(dirpath, previous_build_dirname or '', BUDGET_REPORT_FILENAME)
+        if previous_build_dirname is not None and os.path.isfile(previous_budget_report_path):
+            with open(previous_budget_report_path, 'r') as f:
+                previous_budget_report = json.load(f)
+        # only the pages whose weight changed, the report has every page
+        for page_relpath, weight in budget_report.items():
+            previous_weight = previous_budget_report.get(page_relpath)
+            if previous_weight is not None and all(previous_weight.get(limit) == weight[limit] for limit in BUDGET_LIMITS):
+                continue
+            summary.write(f'Budget {page_relpath}: ' + ', '.join(
+                f'{weight[limit]} {limit}' + (
+                    f' ({weight[limit] - previous_weight[limit]:+})'
+                    if previous_weight is not None and previous_weight.get(limit, weight[limit]) != weight[limit] else ''
+                )
+                for limit in BUDGET_LIMITS
+            ) + '\n')
 
-    # FIXME we need to separate res into cdn res versus actually used on the site
-    # purge_unused_css()
+        # the limits fit a build with the flags that make it small, e.g. `--precompress --critical-css --bundle`,
+        # so only a build that asks for it is held to them
+        exceeded = over_budget(budget_report, budget_config) if enforce_budgets else []
+        if exceeded:
+            write_summary()
+            for page_relpath, limit, value, max_value in exceeded:
+                print(f'Error: "{page_relpath}" {limit} is {value}, over its budget of {max_value}', file=sys.stderr)
+            print(f'Error: {len(exceeded)} budgets exceeded, "{build_dirpath}" is not linked\n', file=sys.stderr)
+            sys.exit(1)
 
-    gen.build_phase = 'final'
-    for target in page_targets:
-        process_page(*target)
-    for target in j2_targets:
-        process_j2(*target)
+        # the manifest marks a finished build for `rollback`, so a rejected build has none
+        write_json(os.path.join(build_root_dirpath, MANIFEST_FILENAME), {
+            'files': files,
+            'fingerprints': fingerprints,
+            'preloads': page_preloads,
+        })
 
-    sys.stdout.write(f'Done building "{build_dirpath}"\n')
+        if check_links:
+            with profile.span('links', build_dirpath):
+                links_report = link_report(build_dirpath, files, pool.process_executor(), summary, fingerprints=fingerprints, cache=build_cache)
+                write_json(os.path.join(build_root_dirpath, LINKS_REPORT_FILENAME), links_report)
+            # reported, not failed: the deploy adds files to the build, e.g. the Makefile's api.html
+            for kind, lines in [
+                ('dangling', [f'"{link["file"]}" -> {link["ref"]}' for link in links_report['dangling']]),
+                ('orphaned', [f'"{path}"' for path in links_report['orphans']]),
+            ]:
+                summary.write(f'Links {len(lines)} {kind}\n')
+                for line in lines[:LINKS_SHOWN_COUNT]:
+                    summary.write(f'    {line}\n')
+                if LINKS_SHOWN_COUNT < len(lines):
+                    summary.write(f'    ... see "{os.path.join(build_root_dirpath, LINKS_REPORT_FILENAME)}"\n')
 
-    build_linkpath = os.path.join(dirpath, 'build')
-    if os.path.islink(build_linkpath):
-        os.remove(build_linkpath)
-    os.symlink(build_dirname, build_linkpath, target_is_directory=True)
+        if pack:
+            pack_path = os.path.join(build_root_dirpath, PACK_FILENAME)
+            with profile.span('pack', pack_path):
+                entry_count, blob_count = pack_site(build_dirpath, files, pack_path)
+            summary.write(f'Packed {entry_count} files, {blob_count} distinct contents into "{pack_path}"\n')
+
+        if build_files.reads:
+            summary.write(f'Read {build_files.reads} build files for rendering, {build_files.hits} memoized reads\n')
+
+        if build_cache is not None:
+            with open(os.path.join(dirpath, 'gen.py'), 'rb') as f:
+                gen_hash = Cache.hash(f.read())
+            # the dependency graph of the final render of each template
+            build_cache.write_json('deps.json', {
+                'gen': gen_hash,
+                'templates': render_deps,
+            })
+            summary.write(f'Cache {build_cache.hits} hits, {build_cache.misses} misses\n')
+
+        profile_path = os.path.join(build_root_dirpath, PROFILE_FILENAME)
+        profile.write(profile_path)
+        summary.write(f'Profile written to "{profile_path}"\n')
+        summary.write(profile.summary())
+
+        if render_profiler is not None:
+            import pstats
+
+            render_profile_path = os.path.join(build_root_dirpath, RENDER_PROFILE_FILENAME)
+            render_profiler.dump_stats(render_profile_path)
+            summary.write(f'Render profile written to "{render_profile_path}", the slowest calls:\n')
+            pstats.Stats(render_profiler, stream=summary).sort_stats('cumulative').print_stats(20)
+
+        summary.write(f'Done building "{build_dirpath}"\n')
+
+        publish(dirpath, build_root_dirname)
+        summary.write(f'Linked to "{os.path.join(dirpath, "build")}"\n')
+
+        if keep is not None:
+            pruned_count = prune_builds(dirpath, keep)
+            if pruned_count:
+                summary.write(f'Pruning {pruned_count} old builds in the background\n')
+
+        write_summary()
+
+    try:
+        run_tasks(initial_tasks + purge_tasks + font_tasks + bundle_tasks + fingerprint_tasks + final_tasks, jobs=jobs, profile=profile, executor=pool.executor)
+        finish()
+    finally:
+        materializer.save()
+        if not serve:
+            close()
+
+    if not serve:
+        return
+
+    def update(paths):
+        """Processes the changed source `paths` again and re-renders the templates that depend on them,
+        using the dependency graph of the last render. Returns the changed build paths,
+        or `None` when gen.py changed and the site needs a full build."""
+        if 'gen.py' in paths:
+            return None
+
+        log = TaskLog()
+        changed_paths = []
+        render_targets = set()
+        try:
+            for path in sorted(paths):
+                if not os.path.isfile(os.path.join(dirpath, path)):
+                    continue
+                target = os.path.split(path)
+                process = processor(target[1])
+                if process in [process_page, process_j2]:
+                    # a layout or partial re-renders through the templates that use it, below
+                    if not any(path in deps['templates'] for template_path, deps in render_deps.items() if template_path != path):
+                        render_targets.add(target)
+                else:
+                    os.makedirs(os.path.join(build_dirpath, target[0]), exist_ok=True)
+                    process(log, 'initial', *target)
+                    changed_paths.append(path)
 
-    sys.stdout.write(f'Linked to "{build_linkpath}"\n')
+            # templates that include a changed template or read a changed build file
+            for template_path, deps in list(render_deps.items()):
+                if any(path in deps['templates'] or path in deps['resources'] for path in paths):
+                    render_targets.add(os.path.split(template_path))
+
+            for target in sorted(render_targets):
+                os.makedirs(os.path.join(build_dirpath, target[0]), exist_ok=True)
+                processor(target[1])(log, 'final', *target)
+                changed_paths.append(os.path.join(*target))
+        finally:
+            log.dump()
+        return changed_paths
+
+    import types
+    return types.SimpleNamespace(update=update, close=close)
+
+
+def build_sites(dirpaths, jobs=1, sidecar=True, minify=True, validate=True, **kwargs):
+    """Builds the sites of `dirpaths` concurrently in this process, sharing one `BuildPool`.
+    Raises the first failure once every site is done."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = BuildPool(jobs=jobs, sidecar=(sidecar and (minify or validate)))
+    try:
+        with ThreadPoolExecutor(max_workers=len(dirpaths)) as executor:
+            futures = [
+                executor.submit(build, dirpath, minify=minify, validate=validate, jobs=jobs, pool=pool, **kwargs)
+                for dirpath in dirpaths
+            ]
+        for future in futures:
+            future.result()
+    finally:
+        pool.close()
+
+
+class Watcher:
+    """Waits for changes to the source files of the site at `dirpath`.
+    Uses inotify on linux and polls the file mtimes elsewhere.
+    """
+
+    # see inotify(7)
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+
+    # changes within this many seconds of each other are reported together, e.g. an editor's save
+    SETTLE_SECONDS = 0.05
+    POLL_SECONDS = 0.25
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.fd = None
+        # inotify watch descriptor -> source dir path
+        self.watches = {}
+        self.mtimes = None
+        try:
+            import ctypes
+            import ctypes.util
+
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            fd = -1
+        if 0 <= fd:
+            self.fd = fd
+            for source_dirpath in self._dirpaths():
+                self._add_watch(source_dirpath)
+        else:
+            self.mtimes = self._mtimes()
+
+    def _ignored(self, path):
+        parts = path.split(os.sep)
+        return (
+            parts[0].startswith('build') or parts[0] == CACHE_DIRNAME or
+            '__pycache__' in parts or parts[-1] == '.DS_Store'
+        )
+
+    def _dirpaths(self):
+        for source_dirpath, source_dirnames, _ in os.walk(self.dirpath, followlinks=True):
+            source_dirnames[:] = [
+                source_dirname
+                for source_dirname in source_dirnames
+                if not self._ignored(os.path.relpath(os.path.join(source_dirpath, source_dirname), self.dirpath))
+            ]
+            yield source_dirpath
+
+    def _mtimes(self):
+        mtimes = {}
+        for source_dirpath in self._dirpaths():
+            for source_filename in os.listdir(source_dirpath):
+                path = os.path.join(source_dirpath, source_filename)
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    mtimes[os.path.relpath(path, self.dirpath)] = (stat.st_mtime_ns, stat.st_size)
+        return mtimes
+
+    def _add_watch(self, source_dirpath):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(source_dirpath), mask)
+        if 0 <= wd:
+            self.watches[wd] = source_dirpath
+
+    def _read_events(self):
+        import struct
+
+        paths = set()
+        data = os.read(self.fd, 65536)
+        i = 0
+        while i < len(data):
+            wd, mask, _, name_length = struct.unpack_from('iIII', data, i)
+            name = data[i + 16:i + 16 + name_length].rstrip(b'\0').decode('utf-8', 'replace')
+            i += 16 + name_length
+            if mask & self.IN_Q_OVERFLOW:
+                # events were lost, so report every file
+                paths.update(self._mtimes())
+                continue
+            if wd not in self.watches:
+                continue
+            path = os.path.join(self.watches[wd], name)
+            relpath = os.path.relpath(path, self.dirpath)
+            if self._ignored(relpath):
+                continue
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # files created before the watch was added are reported with it
+                    for source_dirpath in [path] + [p for p in self._dirpaths() if p.startswith(path + os.sep)]:
+                        self._add_watch(source_dirpath)
+                        for source_filename in os.listdir(source_dirpath):
+                            paths.add(os.path.relpath(os.path.join(source_dirpath, source_filename), self.dirpath))
+            else:
+                paths.add(relpath)
+        return paths
+
+    def wait(self):
+        """Blocks until some source files change. Returns their paths relative to `dirpath`."""
+        import select
+        import time
+
+        if self.fd is not None:
+            paths = set()
+            timeout = None
+            while True:
+                readable, _, _ = select.select([self.fd], [], [], timeout)
+                if not readable:
+                    return paths
+                paths.update(self._read_events())
+                if paths:
+                    timeout = self.SETTLE_SECONDS
+
+        while True:
+            time.sleep(self.POLL_SECONDS)
+            mtimes = self._mtimes()
+            paths = {
+                path
+                for path in set(mtimes) | set(self.mtimes)
+                if mtimes.get(path) != self.mtimes.get(path)
+            }
+            self.mtimes = mtimes
+            if paths:
+                return paths
+
+
+# number of newest builds that `serve` keeps, the linked build is always kept
+SERVE_KEEP = 2
+
+# added to every html page that `serve` returns
+LIVE_RELOAD_SCRIPT = """<script>new EventSource('/__webgen/reload').onmessage = () => location.reload()</script>"""
+
+
+def serve(dirpath, port=8000, minify=False, validate=False, jobs=1):
+    """Builds the site, then serves the current build from memory and re-renders what a source change affects.
+    Pages reload in the browser after each change."""
+    import http.server
+    import mimetypes
+    import threading
+    import time
+    import traceback
+
+    def full_build():
+        # each gen.py change is a full build, so only the last few are kept
+        return build(dirpath, minify=minify, validate=validate, jobs=jobs, single_pass=True, keep=SERVE_KEEP, serve=True)
+
+    site = full_build()
+    watcher = Watcher(dirpath)
+
+    # url path -> (content, content type), emptied on every change
+    files = {}
+    changes = threading.Condition()
+    # bumped on every change, the live reload connections wait for it
+    version = [0]
+
+    def load(url_path):
+        build_dirpath = os.path.realpath(os.path.join(dirpath, 'build'))
+        path = os.path.normpath(url_path.split('?', 1)[0].lstrip('/'))
+        if path.startswith('..'):
+            return None
+        # like nginx `try_files $uri $uri.html $uri/index.html`
+        for candidate_path in [path, f'{path}.html', os.path.join(path, 'index.html')]:
+            file_path = os.path.join(build_dirpath, candidate_path)
+            if os.path.isfile(file_path):
+                with open(file_path, 'rb') as f:
+                    content = f.read()
+                content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+                if content_type == 'text/html':
+                    content = content + LIVE_RELOAD_SCRIPT.encode('utf-8')
+                    content_type = 'text/html; charset=utf-8'
+                return content, content_type
+        return None
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/__webgen/reload':
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                with changes:
+                    seen_version = version[0]
+                    changes.wait_for(lambda: seen_version != version[0])
+                try:
+                    self.wfile.write(b'data: reload\n\n')
+                except OSError:
+                    pass
+                return
+
+            with changes:
+                file = files.get(self.path)
+            if file is None:
+                file = load(self.path)
+                if file is not None:
+                    with changes:
+                        files[self.path] = file
+            if file is None:
+                self.send_error(404)
+                return
+            content, content_type = file
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sys.stdout.write(f'Serving "{os.path.join(dirpath, "build")}" at http://localhost:{port}/\n')
+    sys.stdout.flush()
+
+    try:
+        while True:
+            paths = watcher.wait()
+            sys.stdout.write(f'[watch] Changed {", ".join(sorted(paths))}\n')
+            sys.stdout.flush()
+            start = time.monotonic()
+            try:
+                if site.update(paths) is None:
+                    site.close()
+                    site = full_build()
+                sys.stdout.write(f'[watch] Updated in {time.monotonic() - start:.2f}s\n')
+                sys.stdout.flush()
+            except (Exception, SystemExit):
+                # keep serving the last good output until the next change
+                traceback.print_exc()
+            with changes:
+                files.clear()
+                version[0] += 1
+                changes.notify_all()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        site.close()
 
 
 def webgen(args):
-    gen_py_path = args['<gen.py>']
+    dirpaths = []
+    for gen_py_path in args['<gen.py>']:
+        if not os.path.isfile(gen_py_path):
+            print(f'Error: "{gen_py_path}" does not exist\n', file=sys.stderr)
+            sys.exit(1)
 
-    if not os.path.isfile(gen_py_path):
-        print(f'Error: "{gen_py_path}" does not exist\n', file=sys.stderr)
-        sys.exit(1)
+        dirpath, basename = os.path.split(gen_py_path)
+        if basename != 'gen.py':
+            print('Error: gen.py must point to file named "gen.py"\n', file=sys.stderr)
+            sys.exit(1)
+        if os.path.realpath(dirpath) in map(os.path.realpath, dirpaths):
+            print(f'Error: "{gen_py_path}" is given more than once\n', file=sys.stderr)
+            sys.exit(1)
+        dirpaths.append(dirpath)
 
-    dirpath, basename = os.path.split(gen_py_path)
-    if basename != 'gen.py':
-        print('Error: gen.py must point to file named "gen.py"\n', file=sys.stderr)
-        sys.exit(1)
+    # by default each site has its own store
+    store_dirpath = args['--store']
 
     if args['clean']:
-        clean(dirpath)
+        for dirpath in dirpaths:
+            clean(dirpath, store_dirpath=store_dirpath or os.path.join(dirpath, CACHE_DIRNAME, 'store'))
+        return
+
+    if args['precompile']:
+        for dirpath in dirpaths:
+            precompile(dirpath)
+        return
+
+    if args['delta']:
+        if len(dirpaths) != 1:
+            print('Error: delta takes one gen.py\n', file=sys.stderr)
+            sys.exit(1)
+        delta(dirpaths[0], from_build=args['--from'], out=args['--out'])
+        return
+
+    if args['rollback']:
+        for dirpath in dirpaths:
+            rollback(dirpath, to=args['--to'])
+        return
+
+    jobs = int(args['--jobs'])
+    if jobs < 1:
+        print('Error: --jobs must be at least 1\n', file=sys.stderr)
+        sys.exit(1)
+
+    if args['serve']:
+        if len(dirpaths) != 1:
+            print('Error: serve takes one gen.py\n', file=sys.stderr)
+            sys.exit(1)
+        serve(
+            dirpaths[0],
+            port=int(args['--port']),
+            minify=args['--minify'],
+            validate=args['--validate'],
+            jobs=jobs
+        )
         return
 
     if args['build']:
-        build(dirpath)
+        if args['--materialize'] not in ['copy', 'auto']:
+            print('Error: --materialize must be "copy" or "auto"\n', file=sys.stderr)
+            sys.exit(1)
+        keep = int(args['--keep'])
+        if keep < 1:
+            print('Error: --keep must be at least 1\n', file=sys.stderr)
+            sys.exit(1)
+        build_args = dict(
+            jobs=jobs,
+            sidecar=not args['--no-sidecar'],
+            cache=not args['--no-cache'],
+            materialize=args['--materialize'],
+            store_dirpath=store_dirpath,
+            compress_outputs=args['--precompress'],
+            fingerprint=args['--fingerprint'],
+            single_pass=args['--single-pass'],
+            critical_css=args['--critical-css'],
+            purge_css=args['--purge-css'],
+            optimize_images=args['--images'],
+            subset_fonts=args['--subset-fonts'],
+            bundle_assets=args['--bundle'],
+            enforce_budgets=args['--budgets'],
+            pack=args['--pack'],
+            check_links=args['--check-links'],
+            profile_render=args['--profile'],
+            keep=keep
+        )
+        if len(dirpaths) == 1:
+            build(dirpaths[0], **build_args)
+        else:
+            build_sites(dirpaths, **build_args)
         return
 
 